@@ -1,6 +1,7 @@
 from .address_book_main import address_book_main_func
 from .notes_main import notes_main_func
 from .sort_main import sort_main_func
+from .sort_functions import SCAN_WORKERS
 from rich import print as rprint
 
 TEXT_COLOR = {
@@ -13,7 +14,7 @@ def main_func():
     print("\nHi, I'm your personal helper!")
 
     while True:
-        rprint("\nYou can run: \n-'addressbook'\n-'notebook' \n-'sorting_files *path*'\n\nOr close your personal helper by 'close' or 'exit'")
+        rprint("\nYou can run: \n-'addressbook'\n-'notebook' \n-'sorting_files *path* [--dry-run | --undo | --incremental | --pipeline | --parallel-scan | --sniff | --sniff-all | --link-duplicates | --drop-duplicates]'\n\nOr close your personal helper by 'close' or 'exit'")
 
         choose_program_inp = input('\nChoose the program >>> ')
 
@@ -28,9 +29,18 @@ def main_func():
         elif input_split_list[0] == 'sorting_files':
             try:
                 arg = input_split_list[1]
-                confirm_input = input(TEXT_COLOR['red'] + f"\nAre you sure you want to sort all the files in ({arg}) path !? \n(y/n) >>> " + TEXT_COLOR['reset'])
+                options = input_split_list[2:]
+                dedup = "drop" if '--drop-duplicates' in options else "link" if '--link-duplicates' in options else None
+                scan_workers = SCAN_WORKERS if '--parallel-scan' in options else 1
+                sniff = "all" if '--sniff-all' in options else "unknown" if '--sniff' in options else None
+                if '--dry-run' in options:
+                    sort_main_func(arg, dry_run=True, incremental='--incremental' in options, dedup=dedup, scan_workers=scan_workers, sniff=sniff)
+                    continue
+                action = "undo the sorting of" if '--undo' in options else "sort"
+                confirm_input = input(TEXT_COLOR['red'] + f"\nAre you sure you want to {action} all the files in ({arg}) path !? \n(y/n) >>> " + TEXT_COLOR['reset'])
                 if confirm_input.lower() == 'y':
-                    sort_main_func(arg)
+                    sort_main_func(arg, undo='--undo' in options, incremental='--incremental' in options, dedup=dedup, pipeline='--pipeline' in options,
+                                   scan_workers=scan_workers, sniff=sniff)
                 elif confirm_input.lower() == 'n':
                     print('\nOk')
                 else:
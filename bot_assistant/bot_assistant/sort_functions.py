@@ -1,7 +1,20 @@
-from copy import deepcopy
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+import errno
+import hashlib
+import heapq
+import json
 import logging
+import mmap
+import os
+import pathlib
+from platformdirs import user_data_dir
+from queue import Empty, Full, Queue
 import re
-from threading import Thread, RLock
+import shutil
+import threading
+from time import perf_counter
 
 
 CATEGORY_EXTS = {
@@ -12,135 +25,1004 @@ CATEGORY_EXTS = {
     "video": ('avi', 'mp4', 'mov', 'mkv', 'm4v', 'h264', 'h265', 'mp4', 'mpg', 'mpeg', 'rm', 'flv', 'swf', 'vob', 'webm', 'wmv'),
 }
 
+EXT_CATEGORIES = {ext: key for key, exts in CATEGORY_EXTS.items() for ext in exts}
 
 
-def check_path(path, defined_files, rlock):
-    for key in defined_files:
-        if path.suffix.removeprefix(".").casefold() in CATEGORY_EXTS[key]:
-            rlock.acquire()
-            defined_files[key].append(path)
-            rlock.release()
-            logging.debug(f'Done {path.name}')
-            break
+def signature(*parts):
+    # Bytes match literally, an int n stands for n bytes of any value
+    pattern = []
+    for part in parts:
+        pattern.extend([None] * part if isinstance(part, int) else part)
+    return tuple(pattern)
 
 
-def define_data(path):
-    defined_files = {}
-    category_dirs = []
-    for key in CATEGORY_EXTS:
-        defined_files[key] = []
-        category_dirs.append(path.joinpath(key))
+# Magic bytes at the start of a file, the longest matching signature wins. Short printable magics
+# (ID3, BZh, FWS, CWS) are followed by the version or format bytes that come after them, so text
+# files that just start with those letters aren't taken for audio, archives or video (see also
+# SIGNATURE_CHECKS).
+SIGNATURES = {
+    "archives": (
+        signature(b"PK\x03\x04"), signature(b"PK\x05\x06"), signature(b"\x1f\x8b"), signature(b"7z\xbc\xaf\x27\x1c"),
+        signature(b"Rar!\x1a\x07"), signature(b"\x60\xea"), signature(b"!<arch>\ndebian"), signature(b"\xed\xab\xee\xdb"),
+        *(signature(b"BZh", bytes([level]), b"1AY&SY") for level in b"123456789"), signature(b"\xfd7zXZ\x00"),
+        signature(257, b"ustar"),
+    ),
+    "audio": (
+        *(signature(b"ID3", bytes([version]), b"\x00") for version in (2, 3, 4)), signature(b"\xff\xfb"), signature(b"\xff\xf3"), signature(b"\xff\xf2"), signature(b"OggS"),
+        signature(b"fLaC"), signature(b"RIFF", 4, b"WAVE"), signature(b"#!AMR"), signature(b"FORM", 4, b"AIFF"),
+        signature(4, b"ftypM4A"),
+    ),
+    "documents": (
+        signature(b"%PDF-"), signature(b"{\\rtf"), signature(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"), signature(b"AT&TFORM"),
+        signature(b"PK\x03\x04", 26, b"[Content_Types].xml"), signature(b"PK\x03\x04", 26, b"mimetypeapplication/vnd.oasis.opendocument"),
+    ),
+    "images": (
+        signature(b"\xff\xd8\xff"), signature(b"\x89PNG\r\n\x1a\n"), signature(b"GIF87a"), signature(b"GIF89a"), signature(b"BM", 4, b"\x00\x00\x00\x00"),
+        signature(b"II*\x00"), signature(b"MM\x00*"), signature(b"RIFF", 4, b"WEBP"), signature(b"8BPS"), signature(b"\x00\x00\x01\x00"),
+        signature(b"<svg"), signature(4, b"ftypheic"), signature(4, b"ftypavif"),
+    ),
+    "video": (
+        signature(4, b"ftyp"), signature(b"RIFF", 4, b"AVI "), signature(b"\x1aE\xdf\xa3"), signature(b"FLV\x01"),
+        signature(b"\x00\x00\x01\xba"), signature(b"\x00\x00\x01\xb3"),
+        *(signature(magic, bytes([version])) for magic in (b"FWS", b"CWS") for version in range(1, 0x30)),
+    ),
+}
 
-    rlock = RLock()
-    logging.basicConfig(level=logging.DEBUG, format='%(threadName)s %(message)s')
+MOVE_WORKERS = 8
+SCAN_WORKERS = 8
+SNIFF_WORKERS = 8
+SNIFF_SIZE = 512
+COPY_BUFFER_SIZE = 1024 * 1024
+JOURNAL_NAME = ".sort_journal.jsonl"
+PLAN_NAME = ".sort_plan.jsonl"
+INDEX_VERSION = 1
+HASH_WORKERS = 8
+PARTIAL_HASH_SIZE = 64 * 1024
+PIPELINE_QUEUE_SIZE = 1024
+QUEUE_POLL_INTERVAL = 0.1
+PROGRESS_INTERVAL = 0.5
 
-    threads = []
-    for i in path.glob("**/*"):
-        if i.is_file() and i.parent not in category_dirs:
-            thread = Thread(target=check_path, args=(i, defined_files, rlock))
-            thread.start()
-            threads.append(thread)
-    [el.join() for el in threads]
 
-    for key in CATEGORY_EXTS:
-        if not defined_files[key]:
-            defined_files.pop(key)
+class PlanEntry:
+    # One file of the sort plan. The stages annotate the entries in place instead of copying the plan,
+    # __slots__ keeps an entry at a few dozen bytes on top of its path strings
+    __slots__ = ("source", "category", "name", "target", "size")
+
+    def __init__(self, source, category=None, size=0, target=None):
+        self.source = source
+        self.category = category
+        self.name = None  # set by rename_duplicates, None keeps the source name
+        self.target = target
+        self.size = size
+
+
+def define_category(name):
+    return EXT_CATEGORIES.get(os.path.splitext(name)[1][1:].casefold())
+
+
+def list_dir(current, skip_files=False, index=None):
+    # One directory of the walk. Returns its index record (None without an index), the subdirectories
+    # to visit and the file entries to yield. DirEntry caches the file type so nothing is stat'ed twice.
+    # With an index (see load_index) a directory whose mtime didn't change since the last run isn't
+    # listed again, only its known subdirectories are visited, and files with the same mtime, size
+    # and inode as last time are left out.
+    known = None
+    if index is not None:
+        known = index.get(current)
+        mtime = os.stat(current).st_mtime_ns
+        if known and known[0] == mtime:
+            return known, [os.path.join(current, name) for name in known[1]], []
+    subdirs, files, found = [], {}, []
+    with os.scandir(current) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif not skip_files and entry.is_file():
+                if index is not None:
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                    if known and known[2].get(entry.name) == files[entry.name]:
+                        continue
+                found.append(entry)
+    record = (mtime, tuple(subdirs), files) if index is not None else None
+    return record, [os.path.join(current, name) for name in subdirs], found
+
+
+def scan_files(path, skip_dirs=(), index=None):
+    # Iterative walk over list_dir, files directly inside skip_dirs are not yielded, their
+    # subdirectories still are walked. The index is replaced with what this walk has seen.
+    visited = {}
+    stack = [os.fspath(path)]
+    while stack:
+        current = stack.pop()
+        try:
+            record, subdirs, found = list_dir(current, current in skip_dirs, index)
+        except OSError as error:
+            logging.debug(f'Skipped {current}: {error}')
+            continue
+        if record:
+            visited[current] = record
+        stack.extend(subdirs)
+        yield from found
+
+    if index is not None:
+        index.clear()
+        index.update(visited)
+
+
+def scan_files_parallel(roots, skip_dirs=(), index=None, workers=SCAN_WORKERS):
+    # scan_files over one or several roots with directories listed in a thread pool, scandir and stat
+    # release the GIL. At most a few directories per worker are in flight, and results are taken in
+    # submission order, so the files come breadth-first in the same order on every run.
+    # Paths are compared as given: roots and skip_dirs must be normalised the same way by the caller.
+    if isinstance(roots, (str, os.PathLike)):
+        roots = [roots]
+    visited = {}
+    waiting = deque()
+    seen = set()
+    for root in roots:
+        root = os.fspath(root)
+        if root not in seen:
+            seen.add(root)
+            waiting.append(root)
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        while waiting or pending:
+            while waiting and len(pending) < workers * 4:
+                current = waiting.popleft()
+                pending.append((current, executor.submit(list_dir, current, current in skip_dirs, index)))
+            current, future = pending.popleft()
+            try:
+                record, subdirs, found = future.result()
+            except OSError as error:
+                logging.debug(f'Skipped {current}: {error}')
+                continue
+            if record:
+                visited[current] = record
+            # Nested roots are walked only once
+            for subdir in subdirs:
+                if subdir not in seen:
+                    seen.add(subdir)
+                    waiting.append(subdir)
+            yield from found
+
+    if index is not None:
+        index.clear()
+        index.update(visited)
+
+
+def get_index_path(path):
+    # Kept in the user data dir, one file per sorted folder: anyone can drop files into a Downloads folder
+    data_dir = pathlib.Path(user_data_dir("Personal assistant"))
+    if os.name == "nt":
+        data_dir = data_dir.parent
+    data_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.blake2b(os.fsencode(path), digest_size=16).hexdigest()
+    return os.fspath(data_dir.joinpath(f"sort_index_{key}.json"))
 
-    return defined_files
 
+def load_index(index_path, sniff=None):
+    # {directory: (mtime_ns, subdirectory names, {file name: (mtime_ns, size, inode)})}, stored as JSON.
+    # A missing, foreign or broken file is an empty index, the next walk just lists everything.
+    # So is an index saved with another sniff mode: files it skips were left in place by a run that
+    # classified them differently.
+    try:
+        with open(index_path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        if data["version"] != INDEX_VERSION or data["sniff"] != sniff:
+            return {}
+        return {
+            directory: (mtime, tuple(subdirs), {name: tuple(state) for name, state in files.items()})
+            for directory, (mtime, subdirs, files) in data["dirs"].items()
+        }
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return {}
+
+
+def save_index(index_path, index, sniff=None):
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as fh:
+        json.dump({"version": INDEX_VERSION, "sniff": sniff, "dirs": index}, fh, separators=(",", ":"))
+    os.replace(temp_path, index_path)
+
+
+def update_index(index, path, plan, failed=(), removed_dirs=()):
+    # Brings the index up to date after the moves without walking the tree again
+    for directory in removed_dirs:
+        index.pop(directory, None)
+    # Directories with files that couldn't be moved are listed again on the next run
+    failed_dirs = {os.path.dirname(source) for source in failed}
+    for directory in failed_dirs:
+        index.pop(directory, None)
+
+    # Destinations only got new files, their subdirectories are still the same
+    destinations = {os.path.dirname(entry.target) for entry in plan}
+    for directory in destinations & index.keys():
+        index[directory] = (os.stat(directory).st_mtime_ns,) + index[directory][1:]
+
+    touched = {os.path.dirname(entry.source) for entry in plan} | {os.path.dirname(directory) for directory in removed_dirs}
+    touched.add(os.fspath(path))
+    category_dirs = {os.path.join(path, key) for key in CATEGORY_EXTS}
+    for directory in touched - destinations - failed_dirs:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            subdirs, files = [], {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif directory not in category_dirs and entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            index[directory] = (mtime, tuple(subdirs), files)
+        except OSError:
+            index.pop(directory, None)
+
+
+class SignatureTrie:
+    # Prefix trie over SIGNATURES, a None edge matches any byte
+    __slots__ = ("children", "category", "container", "check")
+
+    def __init__(self):
+        self.children = {}
+        self.category = None
+        self.container = False
+        self.check = None
+
+    @classmethod
+    def compile(cls, signatures, containers=(), checks=None):
+        root = cls()
+        for key, patterns in signatures.items():
+            for pattern in patterns:
+                node = root
+                for byte in pattern:
+                    node = node.children.setdefault(byte, cls())
+                node.category = key
+                node.container = pattern in containers
+                node.check = checks.get(pattern) if checks else None
+        return root
+
+    def match(self, head):
+        # Walks every branch the head fits (exact bytes and wildcards), the deepest category wins.
+        # Returns the category and whether it was matched by a container signature. A signature with
+        # a check only matches when the check accepts the head.
+        best_depth, best = 0, (None, False)
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node.category and depth > best_depth and (node.check is None or node.check(head)):
+                best_depth, best = depth, (node.category, node.container)
+            if depth < len(head):
+                for child in (node.children.get(head[depth]), node.children.get(None)):
+                    if child is not None:
+                        stack.append((child, depth + 1))
+        return best
+
+
+# Container formats hold many kinds of content (zip holds OOXML, PDF holds .ai, RIFF, ftyp, Ogg and
+# Matroska hold both audio and video), a match on them doesn't override a known extension
+CONTAINER_SIGNATURES = {
+    signature(b"PK\x03\x04"), signature(b"PK\x05\x06"), signature(b"PK\x03\x04", 26, b"[Content_Types].xml"),
+    signature(b"PK\x03\x04", 26, b"mimetypeapplication/vnd.oasis.opendocument"), signature(b"%PDF-"),
+    signature(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"), signature(b"RIFF", 4, b"WAVE"), signature(b"RIFF", 4, b"WEBP"),
+    signature(b"RIFF", 4, b"AVI "), signature(4, b"ftyp"), signature(4, b"ftypM4A"), signature(4, b"ftypheic"),
+    signature(4, b"ftypavif"), signature(b"OggS"), signature(b"\x1aE\xdf\xa3"),
+}
+
+# Bytes text files are made of: printable ASCII, whitespace, ESC and anything above 0x7f (UTF-8)
+TEXT_BYTES = bytes(range(0x20, 0x7f)) + bytes(range(0x80, 0x100)) + b"\t\n\r\f\x1b"
+
+
+def is_binary(head):
+    return bool(head.translate(None, TEXT_BYTES))
+
+
+# Conditions on the whole head for signatures that text could still start with: the SWF version
+# byte can be printable punctuation, and SVG is text itself, so it needs its namespace
+SIGNATURE_CHECKS = {
+    **{signature(magic, bytes([version])): is_binary for magic in (b"FWS", b"CWS") for version in range(1, 0x30)},
+    signature(b"<svg"): lambda head: b"http://www.w3.org/2000/svg" in head,
+}
 
-def print_data(defined_files):
-    for key in defined_files:
-        if len(defined_files[key]) > 0:
+SIGNATURE_TRIE = SignatureTrie.compile(SIGNATURES, CONTAINER_SIGNATURES, SIGNATURE_CHECKS)
+
+
+def sniff_category(path):
+    # One small unbuffered read of the head of the file
+    try:
+        with open(path, "rb", buffering=0) as file:
+            head = file.read(SNIFF_SIZE)
+    except OSError:
+        return None, False
+    return SIGNATURE_TRIE.match(head)
+
+
+def classify_entry(entry, sniff=None):
+    # sniff "unknown" reads the files the extension doesn't classify, "all" lets the content of every
+    # file override its extension when a specific (not container) signature matches
+    key = define_category(entry.name)
+    if sniff == "all" or (sniff and not key):
+        sniffed, container = sniff_category(entry.path)
+        if sniffed and not (key and container):
+            key = sniffed
+    if not key:
+        return None
+    try:
+        size = entry.stat().st_size
+    except OSError:
+        size = 0
+    return PlanEntry(entry.path, key, size)
+
+
+def classify_entries(entries, sniff=None, workers=SNIFF_WORKERS):
+    # Sniffing reads files, so it runs in a bounded pool, results keep the walk order
+    if sniff:
+        results = map_bounded(classify_entry, ((entry, sniff) for entry in entries), workers)
+    else:
+        results = map(classify_entry, entries)
+    for plan_entry in results:
+        if plan_entry:
+            yield plan_entry
+
+
+def walk_files(path, index=None, scan_workers=1):
+    # Files to sort under path, category folders' own files are already sorted
+    category_dirs = {os.path.join(path, key) for key in CATEGORY_EXTS}
+    if scan_workers > 1:
+        return scan_files_parallel(path, category_dirs, index, scan_workers)
+    return scan_files(path, category_dirs, index)
+
+
+def define_data(path, index=None, scan_workers=1, sniff=None):
+    return list(classify_entries(walk_files(path, index, scan_workers), sniff))
+
+
+def print_data(plan):
+    for key in CATEGORY_EXTS:
+        names = [os.path.basename(entry.target) for entry in plan if entry.category == key]
+        if names:
             print(f"Files from '{key}' category:")
-            for i in defined_files[key]:
-                print(" " * 8 + f"{i.name}")
-        else:
+            for name in names:
+                print(" " * 8 + f"{name}")
+            print("\n")
+
+
+def rm_empty_dirs(path, plan, failed=(), removed=None):
+    # Removes the directories the moves of the plan left empty, deepest first, and then their parents
+    # that became empty in turn. Only source directories and their ancestors are tried, the rest of
+    # the tree isn't walked. Directories that still hold a failed move are not tried at all.
+    root = os.fspath(path)
+    keep = {root} | {os.path.join(root, key) for key in CATEGORY_EXTS} | {os.path.dirname(source) for source in failed}
+    removed = [] if removed is None else removed
+    candidates = []
+    queued = set()
+
+    def push(directory):
+        if directory not in queued and directory not in keep and directory.startswith(root + os.sep):
+            queued.add(directory)
+            # A child is always deeper than its parent, so the heap hands out children first
+            heapq.heappush(candidates, (-directory.count(os.sep), directory))
+
+    for entry in plan:
+        push(os.path.dirname(entry.source))
+    while candidates:
+        _, directory = heapq.heappop(candidates)
+        try:
+            os.rmdir(directory)
+        except OSError:
             continue
-        print("\n")
+        removed.append(directory)
+        push(os.path.dirname(directory))
+    return removed
+
+
+DUPLICATE_ID = re.compile(r"(.*) \((\d+)\)")
 
 
-def rm_empty_dirs(path):
-    for i in path.iterdir():
-        if i.is_dir():
-            rm_empty_dirs(i)
+def rename_duplicates(plan, path=None):
+    # Files with equal names (case-insensitive) in a category get the name "stem (k).ext", where k starts
+    # from the file's place among the duplicates and skips ids already taken by "stem (k)" files.
+    # Only names seen more than once keep a list of entries, the key is "category/name".
+    # With the sorted folder's path, files already in its category folders count as first files,
+    # so a move never replaces a file sorted by an earlier run.
+    first = {}
+    duplicates = {}
+    used_ids = {}
+
+    def add_used_id(name, category):
+        match = DUPLICATE_ID.fullmatch(os.path.splitext(name)[0].casefold())
+        if match:
+            used_ids.setdefault(category + "/" + match[1], set()).add(int(match[2]))
+
+    if path is not None:
+        for category in {entry.category for entry in plan}:
             try:
-                i.rmdir()
+                with os.scandir(os.path.join(path, category)) as entries:
+                    for entry in entries:
+                        first.setdefault(category + "/" + entry.name.casefold(), entry.name)
+                        add_used_id(entry.name, category)
             except OSError:
                 continue
 
+    for i, entry in enumerate(plan):
+        name = os.path.basename(entry.source)
+        key = entry.category + "/" + name.casefold()
+        if key in first:
+            duplicates.setdefault(key, []).append(i)
+        else:
+            first[key] = i
+        add_used_id(name, entry.category)
+
+    for key, i in first.items():
+        if key not in duplicates:
+            continue
+        # An existing file is stored by its name, a planned one by its index
+        category = key.split("/", 1)[0]
+        stem, suffix = os.path.splitext(i if isinstance(i, str) else os.path.basename(plan[i].source))
+        ids = used_ids.setdefault(category + "/" + stem.casefold(), set())
+        id = 1
+        for number, j in enumerate(duplicates[key], 2):
+            # Every id between the previous one and the current one is already taken
+            id = max(id + 1, number)
+            while id in ids:
+                id += 1
+            ids.add(id)
+            plan[j].name = stem + " " + "(" + str(id) + ")" + suffix
+
+    return plan
+
+
+def get_partial_hash(path, size):
+    # Hash of the first and the last block, small files are hashed whole
+    if size <= 2 * PARTIAL_HASH_SIZE:
+        return get_full_hash(path, size)
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        digest.update(file.read(PARTIAL_HASH_SIZE))
+        file.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+        digest.update(file.read(PARTIAL_HASH_SIZE))
+    return digest.digest()
+
+
+def get_full_hash(path, size):
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        try:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+            return digest.digest()
+        except (OSError, ValueError):
+            pass
+        # Not mappable (empty or special files), fall back to large buffered reads
+        buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.digest()
+
+
+def find_duplicates(plan, workers=HASH_WORKERS, kept=()):
+    # Groups of sources with equal content, the first file of a group (in plan order) is the one
+    # to keep. Files are bucketed by size, then by a hash of their first and last blocks, and only
+    # the files still colliding after that are read in full. Empty files are never duplicates,
+    # they are usually placeholders or markers that belong where they are.
+    # kept are (path, size) of files outside the plan (sorted by earlier runs), they come first in
+    # their groups, and groups of kept files only are left out.
+    order = {}
+    by_size = {}
+    for source, size in kept:
+        order[source] = len(order)
+        by_size.setdefault(size, []).append(source)
+    for entry in plan:
+        if entry.size:
+            order[entry.source] = len(order)
+            by_size.setdefault(entry.size, []).append(entry.source)
+    first_planned = len(kept)
+
+    groups = []
+    candidates = [(file, size) for size, same_size in by_size.items() if len(same_size) > 1 for file in same_size]
+    for hash_function in (get_partial_hash, get_full_hash):
+        buckets = {}
+        for (file, size), digest, error in run_bounded(hash_function, candidates, workers):
+            if error:
+                logging.error(f"Can't read {file}: {error}")
+                continue
+            buckets.setdefault((size, digest), []).append(file)
+        candidates = []
+        for (size, _), same_hash in buckets.items():
+            if len(same_hash) < 2:
+                continue
+            # The partial hash of a small file already covers all of its content
+            if hash_function is get_full_hash or size <= 2 * PARTIAL_HASH_SIZE:
+                groups.append(same_hash)
+            else:
+                candidates.extend((file, size) for file in same_hash)
+
+    groups = [sorted(group, key=order.get) for group in groups]
+    return [group for group in groups if order[group[-1]] >= first_planned]
+
+
+def list_sorted_files(path, plan):
+    # (path, size) of the files already in the category folders of the plan with a size some planned
+    # file has, the candidates for duplicates sorted by earlier runs
+    sizes = {entry.size for entry in plan if entry.size}
+    files = []
+    for category in {entry.category for entry in plan}:
+        try:
+            with os.scandir(os.path.join(path, category)) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_size in sizes:
+                        files.append((entry.path, entry.stat().st_size))
+        except OSError:
+            continue
+    return files
+
+
+def link_duplicate(original, duplicate):
+    # The link is made next to the duplicate and renamed over it, so the duplicate is never missing
+    temp_path = os.fspath(duplicate) + ".sort_link"
+    os.link(original, temp_path)
+    try:
+        os.replace(temp_path, duplicate)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+
+def dedup_files(plan, action="link", workers=HASH_WORKERS, dry_run=False, path=None):
+    # action "link" replaces duplicates with hardlinks to the kept file, "drop" deletes them and
+    # takes them out of the plan. Returns the plan left to sort and the dedup stats, stats["dropped"]
+    # holds the deleted entries so their directories can still be pruned. A dry run deletes nothing
+    # but still leaves the duplicates out of the plan it shows. With the sorted folder's path, the files
+    # already in its category folders are kept over planned files with the same content.
+    stats = {"groups": 0, "files": 0, "bytes": 0, "errors": 0, "dropped": []}
+    dropped = set()
+    kept = list_sorted_files(path, plan) if path is not None else []
+    sources = {entry.source for entry in plan}
+    for original, *duplicates in find_duplicates(plan, workers, kept):
+        stats["groups"] += 1
+        for duplicate in duplicates:
+            # Files sorted earlier are never touched, even when they duplicate each other
+            if duplicate not in sources:
+                continue
+            try:
+                size = os.stat(duplicate).st_size
+                if action == "drop":
+                    if not dry_run:
+                        os.unlink(duplicate)
+                    dropped.add(duplicate)
+                elif not dry_run:
+                    link_duplicate(original, duplicate)
+            except OSError as error:
+                stats["errors"] += 1
+                logging.error(f"Can't {action} duplicate {duplicate} of {original}: {error}")
+                continue
+            stats["files"] += 1
+            stats["bytes"] += size
+
+    if dropped:
+        stats["dropped"] = [entry for entry in plan if entry.source in dropped]
+        plan = [entry for entry in plan if entry.source not in dropped]
+    return plan, stats
+
 
-def rename_duplicates(defined_files):
-    if not defined_files:
-        return defined_files
-    
-    updated_files = deepcopy(defined_files)
-    for key in defined_files:
-        processed_files = []
-        for i, file in enumerate(defined_files[key]):
-            if i not in processed_files:
-                used_ids = []
-                possible_id = {}
-                number_of_duplicates = 1
-                for j, updated_file in enumerate(updated_files[key]):
-                    if i != j:
-                        if file.name.casefold() == updated_file.name.casefold():
-                            number_of_duplicates += 1
-                            possible_id[j] = number_of_duplicates
-                        if updated_file.stem.casefold().startswith(file.stem.casefold()):
-                            suffix_string = updated_file.stem.casefold().replace(file.stem.casefold(), "")
-                            if suffix_string.find(" ") == 0 and suffix_string.count(" ") == 1 and re.fullmatch(" \(\d+\)", suffix_string):
-                                used_ids.append(int(suffix_string[2:-1]))
-                if possible_id:
-                    for j in possible_id:
-                        id = possible_id[j]
-                        while True:
-                            if id not in used_ids:
-                                updated_files[key].pop(j)
-                                updated_files[key].insert(j, file.parent.joinpath(file.stem + " " + "(" + str(id) + ")" + file.suffix))
-                                used_ids.append(id)
-                                processed_files.append(j)
-                                break
-                            id += 1
-
-    return updated_files
-
-
-def create_folders(path, defined_files):
-    for key in defined_files:
+def create_folders(path, plan):
+    for key in {entry.category for entry in plan}:
         subpath = path.joinpath(key)
         if not subpath.is_dir():
             subpath.mkdir()
 
 
-def change_paths(path, updated_files):
-    if not updated_files:
-        return
-    
-    temp = deepcopy(updated_files)
-    for key in temp:
-        subpath = path.joinpath(key)
-        for i, file in enumerate(temp[key]):
-            temp[key].pop(i)
-            temp[key].insert(i, subpath.joinpath(file.name))
-    return temp
-
-
-def replace(old_path, new_path):
-    old_path.replace(new_path)
-    logging.debug(f'Done {new_path.name}')
-
-
-def replace_files(defined_files, updated_files):
-    if not defined_files:
-        return
-    
-    logging.basicConfig(level=logging.DEBUG, format='%(threadName)s %(message)s')
-
-    for key in defined_files:
-        threads = []
-        for i, file in enumerate(defined_files[key]):
-            thread = Thread(target=replace, args=(file, updated_files[key][i]))
-            thread.start()
-            threads.append(thread)
-        [el.join() for el in threads]
+def change_paths(path, plan):
+    path = os.fspath(path)
+    for entry in plan:
+        entry.target = os.path.join(path, entry.category, entry.name or os.path.basename(entry.source))
+    return plan
+
+
+def run_bounded(function, items, workers=MOVE_WORKERS):
+    # Thread pool that keeps at most a few tasks per worker queued, so huge inputs don't become
+    # millions of pending futures. Yields (item, result, error) as tasks finish.
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {}
+        for item in items:
+            pending[executor.submit(function, *item)] = item
+            if len(pending) >= workers * 4:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), *get_outcome(future)
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), *get_outcome(future)
+
+
+def map_bounded(function, items, workers):
+    # Like run_bounded, but yields the results in input order and lets errors propagate
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, *item))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_outcome(future):
+    error = future.exception()
+    return (None, error) if error else (future.result(), None)
+
+
+def move_file(old_path, new_path, size=None):
+    # Returns the number of bytes moved and the destination directory to fsync (None when renamed in place)
+    if size is None:
+        size = os.stat(old_path).st_size
+    try:
+        os.replace(old_path, new_path)
+        return size, None
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+    # Another filesystem: copy, flush the copy to disk, only then drop the source
+    with open(old_path, "rb") as source, open(new_path, "wb") as target:
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        target.flush()
+        os.fsync(target.fileno())
+    shutil.copystat(old_path, new_path)
+    os.unlink(old_path)
+    return size, os.path.dirname(new_path)
+
+
+def resume_move(id, old_path, new_path, size):
+    # A move interrupted after the rename but before its journal record counts as done. A file that
+    # showed up at the destination since the move was planned is never replaced, the move fails instead.
+    if os.path.lexists(new_path):
+        if not os.path.lexists(old_path):
+            return size, None
+        raise FileExistsError(errno.EEXIST, "Destination already exists", new_path)
+    return move_file(old_path, new_path, size)
+
+
+def make_dirs(directory):
+    # os.makedirs recurses once per missing level and fails on very deep chains, so the missing
+    # parents are collected bottom-up and created top-down in a loop
+    missing = []
+    while directory and not os.path.isdir(directory):
+        missing.append(directory)
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_journal_path(path):
+    return os.path.join(path, JOURNAL_NAME)
+
+
+def get_plan_path(path):
+    # Dry runs save their plan here, the journal may still be needed to resume or undo the last sort
+    return os.path.join(path, PLAN_NAME)
+
+
+def write_journal(journal_path, plan, done=()):
+    # Written next to the journal and renamed over it, a journal being rewritten is never half there
+    temp_path = os.fspath(journal_path) + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as journal:
+        journal.write(json.dumps({"type": "plan", "moves": len(plan)}) + "\n")
+        for id, entry in enumerate(plan):
+            journal.write(json.dumps({"type": "move", "id": id, "source": entry.source, "destination": entry.target, "size": entry.size}) + "\n")
+        for id in sorted(done):
+            journal.write(json.dumps({"type": "done", "id": id}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(temp_path, journal_path)
+
+
+def resolve_targets(path, plan, done=()):
+    # The targets of a saved plan (a reviewed dry run, a crashed run) were picked against the category
+    # folders as they were back then. The moves not done yet get their names again against what the
+    # folders hold now. A move whose source is gone was done before its record was written, it keeps
+    # its target.
+    pending = [entry for id, entry in enumerate(plan) if id not in done and os.path.lexists(entry.source)]
+    for entry in pending:
+        entry.category = os.path.basename(os.path.dirname(entry.target))
+        entry.name = None
+    rename_duplicates(pending, path)
+    change_paths(path, pending)
+    return plan
+
+
+def read_journal(journal_path):
+    # Returns the plan and the ids of the moves that were done and undone
+    plan, done, undone = [], set(), set()
+    with open(journal_path, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut off by a crash
+                continue
+            if record["type"] == "move":
+                plan.append(PlanEntry(record["source"], size=record["size"], target=record["destination"]))
+            elif record["type"] == "done":
+                done.add(record["id"])
+            elif record["type"] == "undone":
+                undone.add(record["id"])
+    return plan, done, undone
+
+
+def open_journal(journal_path):
+    # A line cut off by a crash must not swallow the next record
+    cut_off = False
+    if os.path.exists(journal_path) and os.path.getsize(journal_path):
+        with open(journal_path, "rb") as journal:
+            journal.seek(-1, os.SEEK_END)
+            cut_off = journal.read(1) != b"\n"
+    journal = open(journal_path, "a", encoding="utf-8")
+    if cut_off:
+        journal.write("\n")
+    return journal
+
+
+def journal_is_unfinished(journal_path):
+    if not os.path.exists(journal_path):
+        return False
+    plan, done, undone = read_journal(journal_path)
+    return not undone and len(done) < len(plan)
+
+
+def consume_moves(moves, journal=None, workers=MOVE_WORKERS, on_move=None, timer=None):
+    # Runs (id, source, destination, size) moves on the move pool and records the finished ones in the
+    # journal. on_move(error) is called after every move. timer is perf_counter() at the start of the run.
+    stats = {"files": 0, "bytes": 0, "errors": 0, "failed": [], "seconds": 0.0, "files_per_second": 0.0, "bytes_per_second": 0.0}
+    timer = perf_counter() if timer is None else timer
+    synced_dirs = set()
+    for (id, source, destination, size), result, error in run_bounded(resume_move, moves, workers):
+        if error:
+            stats["errors"] += 1
+            stats["failed"].append(source)
+            logging.error(f"Can't move {source} to {destination}: {error}")
+        else:
+            moved, copied_to = result
+            stats["files"] += 1
+            stats["bytes"] += moved
+            if copied_to:
+                synced_dirs.add(copied_to)
+            if journal:
+                journal.write(json.dumps({"type": "done", "id": id}) + "\n")
+        if on_move:
+            on_move(error)
+
+    # Directory entries of cross-device copies are flushed once per directory, not per file
+    if os.name != "nt":
+        for path in synced_dirs:
+            fsync_dir(path)
+
+    stats["seconds"] = perf_counter() - timer
+    if stats["seconds"]:
+        stats["files_per_second"] = stats["files"] / stats["seconds"]
+        stats["bytes_per_second"] = stats["bytes"] / stats["seconds"]
+    return stats
+
+
+def execute_plan(plan, journal_path=None, workers=MOVE_WORKERS, done=()):
+    timer = perf_counter()
+    for directory in {os.path.dirname(entry.target) for entry in plan}:
+        make_dirs(directory)
+    moves = ((id, entry.source, entry.target, entry.size) for id, entry in enumerate(plan) if id not in done)
+    with open_journal(journal_path) if journal_path else nullcontext() as journal:
+        return consume_moves(moves, journal, workers, timer=timer)
+
+
+def replace_files(plan, workers=MOVE_WORKERS):
+    return execute_plan(plan, workers=workers)
+
+
+def undo_plan(journal_path, workers=MOVE_WORKERS):
+    # Moves every file the journal recorded as done back to where it came from
+    plan, done, undone = read_journal(journal_path)
+    moves = []
+    for id in sorted(done - undone, reverse=True):
+        entry = plan[id]
+        make_dirs(os.path.dirname(entry.source))
+        moves.append((id, entry.target, entry.source, entry.size))
+
+    stats = {"files": 0, "errors": 0}
+    emptied_dirs = set()
+    with open_journal(journal_path) as journal:
+        for (id, destination, source, size), result, error in run_bounded(resume_move, moves, workers):
+            if error:
+                stats["errors"] += 1
+                logging.error(f"Can't move {destination} back to {source}: {error}")
+                continue
+            stats["files"] += 1
+            emptied_dirs.add(os.path.dirname(destination))
+            journal.write(json.dumps({"type": "undone", "id": id}) + "\n")
+
+    # Category folders that only held the moved files go away again
+    for path in emptied_dirs:
+        try:
+            os.rmdir(path)
+        except OSError:
+            continue
+    return stats
+
+
+class LazyJournal:
+    # Journal of sort_pipeline, the plan isn't known up front. The file is only opened (replacing the
+    # journal of the previous run) on the first write, once there is something to move.
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, line):
+        if self.file is None:
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.file.write(json.dumps({"type": "plan", "moves": None}) + "\n")
+        self.file.write(line)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class NameRegistry:
+    # Names taken in one category folder (case-insensitive), for resolving duplicates while the scan
+    # is still going. A taken name becomes "stem (k).ext" spelled like the first file of that name,
+    # with the smallest k from 2 on that is free for that exact name.
+    def __init__(self, names=()):
+        self.taken = {name.casefold(): name for name in names}
+        self.next_ids = {}
+
+    def claim(self, name):
+        key = name.casefold()
+        if key not in self.taken:
+            self.taken[key] = name
+            return name
+        stem, suffix = os.path.splitext(self.taken[key])
+        id = self.next_ids.get(key, 2)
+        while (stem + " " + "(" + str(id) + ")" + suffix).casefold() in self.taken:
+            id += 1
+        self.next_ids[key] = id + 1
+        new_name = stem + " " + "(" + str(id) + ")" + suffix
+        self.taken[new_name.casefold()] = new_name
+        return new_name
+
+
+def open_category(path, key):
+    # Files sorted by earlier runs keep their names, so they are taken from the start
+    category_dir = os.path.join(path, key)
+    os.makedirs(category_dir, exist_ok=True)
+    with os.scandir(category_dir) as entries:
+        return NameRegistry(entry.name for entry in entries)
+
+
+END_OF_STREAM = object()
+
+
+def put_item(queue, item, stop):
+    # A producer blocked on a full queue gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def iter_queue(queue, stop):
+    while True:
+        try:
+            item = queue.get(timeout=QUEUE_POLL_INTERVAL)
+        except Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is END_OF_STREAM:
+            return
+        yield item
+
+
+def start_stage(name, function, items, output, stop, errors, counts):
+    # Runs function(items) in a thread and puts what it yields into output, counting it under name
+    def run():
+        try:
+            for item in function(items):
+                if not put_item(output, item, stop):
+                    return
+                counts[name] += 1
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            put_item(output, END_OF_STREAM, stop)
+
+    thread = threading.Thread(target=run, name=f"sort-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def sort_pipeline(path, index=None, journal_path=None, workers=MOVE_WORKERS, progress=None, queue_size=PIPELINE_QUEUE_SIZE, scan_workers=1,
+                  sniff=None):
+    # Scanning, classification, name resolution and moves run as connected stages, so files are moved
+    # while the tree is still being scanned. Scan and classification are threads behind bounded queues,
+    # names are resolved per category folder with a NameRegistry and go straight into the move pool.
+    # progress(counts) is called from this thread every PROGRESS_INTERVAL seconds and at the end.
+    # Returns the plan that was executed and the same stats as execute_plan.
+    path = os.fspath(path)
+    counts = {"scanned": 0, "classified": 0, "resolved": 0, "moved": 0}
+    stop = threading.Event()
+    errors = []
+    scanned, classified = Queue(queue_size), Queue(queue_size)
+    plan = []
+    registries = {}
+    journal = LazyJournal(journal_path) if journal_path else None
+
+    def resolve(entries):
+        for entry in entries:
+            if entry.category not in registries:
+                registries[entry.category] = open_category(path, entry.category)
+            name = os.path.basename(entry.source)
+            new_name = registries[entry.category].claim(name)
+            if new_name != name:
+                entry.name = new_name
+            entry.target = os.path.join(path, entry.category, new_name)
+            id = len(plan)
+            plan.append(entry)
+            # The move is journaled before it starts, so a crash leaves it to resume or undo
+            if journal:
+                journal.write(json.dumps({"type": "move", "id": id, "source": entry.source, "destination": entry.target, "size": entry.size}) + "\n")
+                journal.flush()
+            counts["resolved"] += 1
+            yield id, entry.source, entry.target, entry.size
+
+    def report(error):
+        nonlocal last_report
+        if not error:
+            counts["moved"] += 1
+        if progress and perf_counter() - last_report >= PROGRESS_INTERVAL:
+            last_report = perf_counter()
+            progress(dict(counts))
+
+    timer = last_report = perf_counter()
+    threads = [
+        start_stage("scanned", lambda _: walk_files(path, index, scan_workers), None, scanned, stop, errors, counts),
+        start_stage("classified", lambda entries: classify_entries(entries, sniff), iter_queue(scanned, stop), classified, stop, errors, counts),
+    ]
+    try:
+        stats = consume_moves(resolve(iter_queue(classified, stop)), journal, workers, report, timer)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        if journal:
+            journal.close()
+    if errors:
+        raise errors[0]
+    if progress:
+        progress(dict(counts))
+    return plan, stats
@@ -1,5 +1,9 @@
+from itertools import chain
+import os
 import pathlib
-from .sort_functions import define_data, print_data, rm_empty_dirs, rename_duplicates, create_folders, change_paths, replace_files
+from .sort_functions import (define_data, print_data, rm_empty_dirs, rename_duplicates, create_folders, change_paths,
+                             execute_plan, get_journal_path, get_plan_path, write_journal, read_journal, journal_is_unfinished, undo_plan,
+                             resolve_targets, get_index_path, load_index, save_index, update_index, dedup_files, sort_pipeline)
 
 
 TEXT_COLOR = {
@@ -9,17 +13,129 @@ TEXT_COLOR = {
 }
 
 
-def sort_main_func(inp_path):
-    path = pathlib.Path(inp_path)
+def print_stats(stats):
+    if stats["files"]:
+        print(TEXT_COLOR["green"] + f"Moved {stats['files']} files ({stats['bytes'] / 2**20:.1f} MB) in {stats['seconds']:.2f} seconds: "
+              f"{stats['files_per_second']:.0f} files/s, {stats['bytes_per_second'] / 2**20:.1f} MB/s" + TEXT_COLOR["reset"])
+    if stats["errors"]:
+        print(TEXT_COLOR["red"] + f"{stats['errors']} files couldn't be moved" + TEXT_COLOR["reset"])
+
+
+def print_dedup_stats(stats, action, dry_run=False):
+    done = {"link": "hardlinked", "drop": "deleted"}[action]
+    verb = f"would be {done}" if dry_run else f"were {done}"
+    print(TEXT_COLOR["green"] + f"Found {stats['groups']} groups of identical files, {stats['files']} duplicates "
+          f"({stats['bytes'] / 2**20:.1f} MB) {verb}" + TEXT_COLOR["reset"])
+    if stats["errors"]:
+        print(TEXT_COLOR["red"] + f"{stats['errors']} duplicates couldn't be {done}" + TEXT_COLOR["reset"])
+
+
+def print_progress(counts):
+    print("\r" + ", ".join(f"{name}: {count}" for name, count in counts.items()), end="", flush=True)
+
+
+def undo_sort(journal_path):
+    if not os.path.exists(journal_path):
+        print(TEXT_COLOR["red"] + "There is no sorting to undo in this folder" + TEXT_COLOR["reset"])
+        return
+    stats = undo_plan(journal_path)
+    print(TEXT_COLOR["green"] + f"Moved {stats['files']} files back" + TEXT_COLOR["reset"])
+    if stats["errors"]:
+        print(TEXT_COLOR["red"] + f"{stats['errors']} files couldn't be moved back, the journal is kept in {journal_path}" + TEXT_COLOR["reset"])
+    else:
+        os.remove(journal_path)
+
+
+def resume_journal(path, journal_path):
+    print(TEXT_COLOR["green"] + f"Continuing the sorting saved in {journal_path}" + TEXT_COLOR["reset"])
+    plan, done, _ = read_journal(journal_path)
+    # Files may have shown up in the category folders since the plan was saved
+    resolve_targets(path, plan, done)
+    write_journal(journal_path, plan, done)
+    stats = execute_plan(plan, journal_path, done=done)
+    print_stats(stats)
+    rm_empty_dirs(path, plan, stats["failed"])
+
+
+def prune_and_save_index(path, index, index_path, plan, failed, dropped=(), sniff=None):
+    # Dropped duplicates left their directories too
+    removed_dirs = rm_empty_dirs(path, chain(plan, dropped), failed)
+
+    # The index is only saved after real moves, a dry run must not hide files from the next run
+    if index is not None:
+        update_index(index, path, plan, failed, removed_dirs)
+        save_index(index_path, index, sniff)
+
+
+def sort_main_func(inp_path, dry_run=False, undo=False, incremental=False, dedup=None, pipeline=False, scan_workers=1,
+                   sniff=None):
+    # One normalised path for the walk, the category folders, pruning, the journal and the index
+    path = pathlib.Path(os.path.abspath(inp_path))
 
     if not path.is_dir():
         print(TEXT_COLOR["red"] + "The argument is path to file or folder doesn't exist" + TEXT_COLOR["reset"])
         return
-    
-    defined_files = define_data(path)
-    updated_files = rename_duplicates(defined_files)
-    updated_files = change_paths(path, updated_files)
-    print_data(updated_files)
-    create_folders(path, defined_files)
-    replace_files(defined_files, updated_files)
-    rm_empty_dirs(path)
+
+    journal_path = get_journal_path(path)
+    if undo:
+        undo_sort(journal_path)
+        return
+
+    # A crashed run leaves moves in the journal that weren't done yet, a reviewed dry run leaves its
+    # plan next to it. The plan only becomes the journal once the crashed run is finished.
+    plan_path = get_plan_path(path)
+    if not dry_run:
+        if journal_is_unfinished(journal_path):
+            resume_journal(path, journal_path)
+        if os.path.exists(plan_path):
+            os.replace(plan_path, journal_path)
+            resume_journal(path, journal_path)
+
+    # Finding the index path creates the data dir, runs without an index don't touch it
+    index_path = get_index_path(path) if incremental else None
+    index = load_index(index_path, sniff) if incremental else None
+    failed = []
+
+    # Duplicates by content and dry runs need the whole plan first, otherwise moves can start during the scan
+    if pipeline and not dry_run and not dedup:
+        plan, stats = sort_pipeline(path, index, journal_path, progress=print_progress, scan_workers=scan_workers, sniff=sniff)
+        print()
+        failed = stats["failed"]
+        print_stats(stats)
+        prune_and_save_index(path, index, index_path, plan, failed, sniff=sniff)
+        return
+
+    # One PlanEntry per file, every stage below fills it in place
+    plan = define_data(path, index, scan_workers, sniff)
+    dropped = []
+    if dedup:
+        plan, dedup_stats = dedup_files(plan, dedup, dry_run=dry_run, path=path)
+        print_dedup_stats(dedup_stats, dedup, dry_run)
+        dropped = dedup_stats["dropped"]
+    rename_duplicates(plan, path)
+    change_paths(path, plan)
+    print_data(plan)
+
+    if dry_run:
+        summary = f"Dry run: {len(plan)} files ({sum(entry.size for entry in plan) / 2**20:.1f} MB) would be moved. "
+        # The saved plan only holds moves, running it would move the duplicates instead of linking or
+        # deleting them. The duplicates are found again by the real run, and an older plan mustn't
+        # be run in its place.
+        if dedup:
+            if os.path.exists(plan_path):
+                os.remove(plan_path)
+            print(TEXT_COLOR["green"] + summary + "Plans with duplicates handling aren't saved, run the sorting again "
+                  "with the same options to execute it" + TEXT_COLOR["reset"])
+            return
+        write_journal(plan_path, plan)
+        print(TEXT_COLOR["green"] + summary + f"The plan is saved in {plan_path}, run the sorting again to execute it" + TEXT_COLOR["reset"])
+        return
+
+    if plan:
+        write_journal(journal_path, plan)
+        create_folders(path, plan)
+        stats = execute_plan(plan, journal_path)
+        failed = stats["failed"]
+        print_stats(stats)
+    prune_and_save_index(path, index, index_path, plan, failed, dropped, sniff)
+
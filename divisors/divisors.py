@@ -1,55 +1,641 @@
+from array import array
+import atexit
 import concurrent.futures
-from multiprocessing import Pool, cpu_count
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import heapq
+from itertools import islice
+from multiprocessing import Pool, cpu_count, shared_memory
 import logging
+from math import ceil, gcd, isqrt
+import os
 from random import randint
-from time import time
+from time import perf_counter, time
+from divisors_classes import DivisorsArray, DivisorsCache, Instrumentation
 
 
 CPU_COUNT = cpu_count()
 
 
-logger = logging.getLogger()
-stream_handler = logging.StreamHandler()
-logger.addHandler(stream_handler)
-logger.setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 
-def get_divisors(number):
+TRIAL_DIVISION_LIMIT = 1000
+MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+SIEVE_LIMIT = 2 * 10**7
+SIEVE_MIN_BATCH = 10**4
+CHUNKS_PER_WORKER = 4
+CHUNKING_POLICIES = ("fixed", "balanced", "guided")
+STREAM_CHUNK_SIZE = 256
+DIVISORS_CACHE_SIZE = 2**16
+STREAM_WINDOW = 4 * CPU_COUNT
+SEGMENT_SIZE = 2**16
+
+
+def get_small_primes(limit):
+    is_prime = bytearray([1]) * (limit + 1)
+    is_prime[0:2] = b"\x00\x00"
+    for i in range(2, int(limit ** 0.5) + 1):
+        if is_prime[i]:
+            is_prime[i * i::i] = bytes(len(range(i * i, limit + 1, i)))
+    return tuple(i for i in range(limit + 1) if is_prime[i])
+
+
+SMALL_PRIMES = get_small_primes(TRIAL_DIVISION_LIMIT)
+
+
+def is_prime(number):
+    if number < 2:
+        return False
+    for p in MILLER_RABIN_BASES:
+        if number % p == 0:
+            return number == p
+    d, s = number - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    # These bases make the test deterministic for every number below 3.3 * 10**24
+    for a in MILLER_RABIN_BASES:
+        x = pow(a, d, number)
+        if x == 1 or x == number - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % number
+            if x == number - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def pollard_rho(number):
+    if number % 2 == 0:
+        return 2
+    # Brent's variant of Pollard's rho, retried with another constant on failure
+    for c in range(1, number):
+        y, r, q, g = 2, 1, 1, 1
+        x = ys = y
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % number
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(128, r - k)):
+                    y = (y * y + c) % number
+                    q = q * abs(x - y) % number
+                g = gcd(q, number)
+                k += 128
+            r *= 2
+        if g == number:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % number
+                g = gcd(abs(x - ys), number)
+        if g != number:
+            return g
+    return number
+
+
+def factorize(number):
+    factors = {}
+    for p in SMALL_PRIMES:
+        if p * p > number:
+            break
+        while number % p == 0:
+            factors[p] = factors.get(p, 0) + 1
+            number //= p
+    if number > 1:
+        stack = [number]
+        while stack:
+            n = stack.pop()
+            if n < TRIAL_DIVISION_LIMIT ** 2 or is_prime(n):
+                factors[n] = factors.get(n, 0) + 1
+            else:
+                d = pollard_rho(n)
+                stack.extend((d, n // d))
+    return dict(sorted(factors.items()))
+
+
+def get_divisors_from_factors(factors):
     divisors = [1]
-    for i in range(2, int(number / 2) + 1):
-        if number % i == 0:
-            divisors.append(i)
-    divisors.append(number)
+    for p, exponent in factors.items():
+        divisors = [d * p ** e for e in range(exponent + 1) for d in divisors]
+    divisors.sort()
     return divisors
 
 
-def get_divisors_of_numbers_single_process(*numbers):
-    timer = time()
-    result = []
-    for number in numbers:
-        divisors = get_divisors(number)
-        result.append(divisors)
-    logging.debug(f"Done with single process in {time() - timer} seconds\n")
+divisors_cache = None
+
+
+def enable_cache(maxsize=DIVISORS_CACHE_SIZE, path=None):
+    global divisors_cache
+    disable_cache()
+    divisors_cache = DivisorsCache(maxsize, path)
+    return divisors_cache
+
+
+def disable_cache():
+    global divisors_cache
+    if divisors_cache is not None:
+        divisors_cache.close()
+    divisors_cache = None
+
+
+# Buffered writes of the sqlite cache reach the file when the program ends
+atexit.register(disable_cache)
+
+
+def get_cache_settings():
+    return (divisors_cache.maxsize, divisors_cache.path) if divisors_cache is not None else None
+
+
+def get_cached_factors(number, cache):
+    factors = cache.get(number)
+    if factors is not None:
+        return factors
+    # For n = p * m with a cached m only the small prime p has to be found
+    stripped = {}
+    cofactor = number
+    for p in SMALL_PRIMES:
+        if p * p > cofactor:
+            break
+        while cofactor % p == 0:
+            cofactor //= p
+            stripped[p] = stripped.get(p, 0) + 1
+            if cofactor == 1:
+                break
+            related = cache.peek(cofactor)
+            if related is not None:
+                cache.related_hits += 1
+                for q, exponent in related.items():
+                    stripped[q] = stripped.get(q, 0) + exponent
+                factors = dict(sorted(stripped.items()))
+                cache.put(number, factors)
+                return factors
+    factors = stripped
+    for q, exponent in factorize(cofactor).items():
+        factors[q] = factors.get(q, 0) + exponent
+    factors = dict(sorted(factors.items()))
+    cache.put(number, factors)
+    return factors
+
+
+def get_divisors(number):
+    # Keeps the results of the original trial division for 1, 0 and negative numbers
+    if number < 2:
+        return [1, number]
+    if divisors_cache is not None:
+        return get_divisors_from_factors(get_cached_factors(number, divisors_cache))
+    return get_divisors_from_factors(factorize(number))
+
+
+spf_sieve = None
+
+
+def build_spf_sieve(limit):
+    # Smallest prime factor of every number up to limit, 0 marks primes (and 0, 1).
+    # Going through primes in descending order lets smaller primes overwrite larger ones.
+    sieve = array("I", bytes(4 * (limit + 1)))
+    for p in reversed(get_small_primes(int(limit ** 0.5))):
+        sieve[p * p::p] = array("I", [p]) * len(range(p * p, limit + 1, p))
+    return sieve
+
+
+def get_spf_sieve(limit):
+    global spf_sieve
+    limit = max(limit, 1)
+    if spf_sieve is None or len(spf_sieve) <= limit:
+        if spf_sieve is not None:
+            limit = max(limit, 2 * (len(spf_sieve) - 1))
+        spf_sieve = build_spf_sieve(limit)
+    return spf_sieve
+
+
+def factorize_with_sieve(number, sieve):
+    factors = {}
+    while number > 1:
+        p = sieve[number] or number
+        exponent = 0
+        while number % p == 0:
+            number //= p
+            exponent += 1
+        factors[p] = exponent
+    return factors
+
+
+def get_divisors_with_sieve(number, sieve):
+    if number < 2:
+        return [1, number]
+    return get_divisors_from_factors(factorize_with_sieve(number, sieve))
+
+
+worker_sieve = None
+worker_sieve_memory = None
+
+
+@contextmanager
+def published_sieve(limit):
+    # Copies the sieve into shared memory once, workers attach to it by name instead of unpickling a copy
+    sieve = get_spf_sieve(limit)
+    size = sieve.itemsize * len(sieve)
+    memory = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        memory.buf[:size] = memoryview(sieve).cast("B")
+        yield memory.name, len(sieve)
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def attach_sieve(name, length):
+    global worker_sieve, worker_sieve_memory
+    worker_sieve_memory = shared_memory.SharedMemory(name=name)
+    worker_sieve = worker_sieve_memory.buf[:4 * length].cast("I")
+
+
+def init_worker(sieve_info=None, cache_settings=None):
+    if sieve_info:
+        attach_sieve(*sieve_info)
+    if cache_settings:
+        enable_cache(*cache_settings)
+
+
+def get_divisors_with_shared_sieve(number):
+    if number < len(worker_sieve):
+        return get_divisors_with_sieve(number, worker_sieve)
+    return get_divisors(number)
+
+
+def should_use_sieve(numbers):
+    if not numbers:
+        return False
+    limit = max(numbers)
+    if spf_sieve is not None and len(spf_sieve) > limit:
+        return True
+    return len(numbers) >= SIEVE_MIN_BATCH and limit <= SIEVE_LIMIT
+
+
+def estimate_cost(number):
+    # Factorization is bounded by trial division up to the square root, divisor lists grow with the bit length
+    return number.bit_length() if number < TRIAL_DIVISION_LIMIT ** 2 else 2 * number.bit_length()
+
+
+def make_chunks(numbers, workers, policy="guided"):
+    # Returns lists of indexes into numbers, in the order they should be sent to the pool
+    if policy not in CHUNKING_POLICIES:
+        raise ValueError(f"Unknown chunking policy: {policy}")
+    if not numbers:
+        return []
+    count = min(len(numbers), workers * CHUNKS_PER_WORKER)
+
+    if policy == "fixed":
+        size = ceil(len(numbers) / count)
+        return [list(range(i, min(i + size, len(numbers)))) for i in range(0, len(numbers), size)]
+
+    costs = [estimate_cost(number) for number in numbers]
+    indexes = sorted(range(len(numbers)), key=costs.__getitem__, reverse=True)
+
+    if policy == "balanced":
+        # Longest processing time first: every number goes to the currently lightest chunk
+        heap = [(0, i) for i in range(count)]
+        chunks = [[] for _ in range(count)]
+        for index in indexes:
+            total, i = heapq.heappop(heap)
+            chunks[i].append(index)
+            heapq.heappush(heap, (total + costs[index], i))
+        return chunks
+
+    # Guided: each chunk takes a share of the remaining cost, so the tail is made of small chunks
+    # that idle workers pick up from the pool queue while the others are still busy
+    chunks = []
+    remaining = sum(costs)
+    min_cost = remaining / (4 * count)
+    chunk, chunk_cost = [], 0
+    for index in indexes:
+        chunk.append(index)
+        chunk_cost += costs[index]
+        if chunk_cost >= max(remaining / (2 * workers), min_cost):
+            chunks.append(chunk)
+            remaining -= chunk_cost
+            chunk, chunk_cost = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def process_chunk(chunk_id, chunk, compact=False):
+    started = time()
+    if worker_sieve is not None:
+        result = [get_divisors_with_shared_sieve(number) for number in chunk]
+    else:
+        result = [get_divisors(number) for number in chunk]
+    if compact:
+        result = DivisorsArray.from_lists(result)
+    # Workers are stopped without running atexit, so each chunk saves what it added to the cache
+    if divisors_cache is not None:
+        divisors_cache.flush()
+    return chunk_id, os.getpid(), started, time(), result
+
+
+def process_chunk_task(task):
+    return process_chunk(*task)
+
+
+def collect_chunks(completed, chunks, size, timer, stats=None, compact=False, instrumentation=None):
+    result = [None] * size
+    workers = {}
+    for chunk_id, pid, started, finished, divisors in completed:
+        if instrumentation is not None:
+            instrumentation.completed(chunk_id, pid, started, finished, divisors)
+        if compact:
+            for position, index in enumerate(chunks[chunk_id]):
+                result[index] = (divisors, position)
+        else:
+            for index, number_divisors in zip(chunks[chunk_id], divisors):
+                result[index] = number_divisors
+        worker = workers.setdefault(pid, {"chunks": 0, "busy": 0.0})
+        worker["chunks"] += 1
+        worker["busy"] += finished - started
+    if stats is not None:
+        wall = perf_counter() - timer
+        for worker in workers.values():
+            worker["utilisation"] = worker["busy"] / wall if wall else 0.0
+        stats.update({"wall": wall, "chunks": len(chunks), "workers": workers})
+    if compact:
+        divisors = DivisorsArray()
+        for chunk_divisors, position in result:
+            divisors.append_from(chunk_divisors, position)
+        return divisors
     return tuple(result)
 
 
-def get_divisors_of_numbers_multi_process_v1(*numbers):
+def get_divisors_of_numbers_single_process(*numbers, use_sieve=None, compact=False):
     timer = time()
-    with Pool(processes=CPU_COUNT) as pool:
-        result = pool.map(get_divisors, numbers)
-    logging.debug(f"Done with {CPU_COUNT} multi processes (Pool from multiprocessing) in {time() - timer} seconds\n")
-    return tuple(result)
+    if use_sieve is None:
+        use_sieve = should_use_sieve(numbers)
+    result = DivisorsArray() if compact else []
+    if use_sieve and numbers:
+        sieve = get_spf_sieve(max(numbers))
+        for number in numbers:
+            divisors = get_divisors_with_sieve(number, sieve)
+            result.append(divisors)
+    else:
+        for number in numbers:
+            divisors = get_divisors(number)
+            result.append(divisors)
+    logger.debug(f"Done with single process in {time() - timer} seconds\n")
+    return result if compact else tuple(result)
 
 
-def get_divisors_of_numbers_multi_process_v2(*numbers):    
+def get_divisors_of_numbers_multi_process_v1(*numbers, use_sieve=None, chunking="guided", stats=None, compact=False, processes=None, instrumentation=None):
     timer = time()
-    with concurrent.futures.ProcessPoolExecutor(CPU_COUNT) as executor:
-        result = executor.map(get_divisors, numbers)
-    logging.debug(f"Done with {CPU_COUNT} multi processes (ProcessPoolExecutor from concurrent.futures) in {time() - timer} seconds\n")
-    return tuple(result)
+    processes = processes or CPU_COUNT
+    if use_sieve is None:
+        use_sieve = should_use_sieve(numbers)
+    with published_sieve(max(numbers)) if use_sieve and numbers else nullcontext() as sieve_info:
+        with Pool(processes, init_worker, (sieve_info, get_cache_settings())) as pool:
+            if chunking is None:
+                result = pool.map(get_divisors_with_shared_sieve if sieve_info else get_divisors, numbers)
+                result = DivisorsArray.from_lists(result) if compact else tuple(result)
+            else:
+                chunks = make_chunks(numbers, processes, chunking)
+                chunk_timer = perf_counter()
+                tasks = [(i, [numbers[j] for j in chunk], compact) for i, chunk in enumerate(chunks)]
+                if instrumentation is not None:
+                    for task in tasks:
+                        instrumentation.submitted(task[0], task)
+                completed = pool.imap_unordered(process_chunk_task, tasks)
+                result = collect_chunks(completed, chunks, len(numbers), chunk_timer, stats, compact, instrumentation)
+    logger.debug(f"Done with {processes} multi processes (Pool from multiprocessing) in {time() - timer} seconds\n")
+    return result
+
+
+def get_divisors_of_numbers_multi_process_v2(*numbers, use_sieve=None, chunking="guided", stats=None, compact=False, processes=None, instrumentation=None):
+    timer = time()
+    processes = processes or CPU_COUNT
+    if use_sieve is None:
+        use_sieve = should_use_sieve(numbers)
+    with published_sieve(max(numbers)) if use_sieve and numbers else nullcontext() as sieve_info:
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker, initargs=(sieve_info, get_cache_settings())) as executor:
+            if chunking is None:
+                result = executor.map(get_divisors_with_shared_sieve if sieve_info else get_divisors, numbers)
+                result = DivisorsArray.from_lists(result) if compact else tuple(result)
+            else:
+                chunks = make_chunks(numbers, processes, chunking)
+                chunk_timer = perf_counter()
+                futures = []
+                for i, chunk in enumerate(chunks):
+                    task = (i, [numbers[j] for j in chunk], compact)
+                    if instrumentation is not None:
+                        instrumentation.submitted(i, task)
+                    futures.append(executor.submit(process_chunk, *task))
+                completed = (future.result() for future in concurrent.futures.as_completed(futures))
+                result = collect_chunks(completed, chunks, len(numbers), chunk_timer, stats, compact, instrumentation)
+    logger.debug(f"Done with {processes} multi processes (ProcessPoolExecutor from concurrent.futures) in {time() - timer} seconds\n")
+    return result
+
+
+def read_numbers(path):
+    with open(path) as file:
+        for line in file:
+            for item in line.split():
+                yield int(item)
+
+
+def iter_number_chunks(numbers, size):
+    numbers = iter(numbers)
+    while chunk := list(islice(numbers, size)):
+        yield chunk
+
+
+def iter_divisors(numbers, processes=CPU_COUNT, ordered=True, window=STREAM_WINDOW, chunk_size=STREAM_CHUNK_SIZE, limit=None, instrumentation=None):
+    # Yields (number, divisors) pairs, at most window chunks of chunk_size numbers are in flight at once.
+    # If the upper bound of the numbers is known, pass it as limit to share the sieve with the workers.
+    chunks = iter_number_chunks(numbers, chunk_size)
+    if processes <= 1:
+        sieve = get_spf_sieve(limit) if limit is not None else None
+        for chunk in chunks:
+            for number in chunk:
+                # Numbers above the limit fall back to factorization, like in the workers
+                yield number, get_divisors_with_sieve(number, sieve) if sieve and number < len(sieve) else get_divisors(number)
+        return
+
+    with published_sieve(limit) if limit is not None else nullcontext() as sieve_info:
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker, initargs=(sieve_info, get_cache_settings())) as executor:
+            tasks = ((chunk_id, process_chunk, (chunk_id, chunk), chunk) for chunk_id, chunk in enumerate(chunks))
+            yield from iter_windowed(executor, tasks, ordered, window, instrumentation)
+
+
+def iter_windowed(executor, tasks, ordered=True, window=STREAM_WINDOW, instrumentation=None):
+    # Submits (task_id, function, args, keys) tasks with at most window of them in flight and yields
+    # (key, result) pairs, function must return (task_id, pid, started, finished, results) with one
+    # result per key. Tasks still pending when the consumer stops are cancelled.
+    pending = {}
+    queue = deque()
+    try:
+        for task_id, function, args, keys in tasks:
+            if instrumentation is not None:
+                instrumentation.submitted(task_id, args)
+            future = executor.submit(function, *args)
+            pending[future] = keys
+            # Only the ordered mode pops from the queue, otherwise it would keep every finished result
+            if ordered:
+                queue.append(future)
+            while len(pending) >= window:
+                yield from pop_completed_chunks(pending, queue, ordered, instrumentation)
+        while pending:
+            yield from pop_completed_chunks(pending, queue, ordered, instrumentation)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def pop_completed_chunks(pending, queue, ordered, instrumentation=None):
+    if ordered:
+        done = [queue.popleft()]
+    else:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+        chunk = pending.pop(future)
+        task_id, pid, started, finished, result = future.result()
+        if instrumentation is not None:
+            instrumentation.completed(task_id, pid, started, finished, result)
+        yield from zip(chunk, result)
+
+
+def get_factors(number):
+    if number < 1:
+        raise ValueError(f"Aggregates are defined for positive integers only, got {number}")
+    for sieve in (worker_sieve, spf_sieve):
+        if sieve is not None and number < len(sieve):
+            return factorize_with_sieve(number, sieve)
+    if divisors_cache is not None:
+        return get_cached_factors(number, divisors_cache)
+    return factorize(number)
+
+
+def count_divisors(factors):
+    count = 1
+    for exponent in factors.values():
+        count *= exponent + 1
+    return count
+
+
+def sum_divisors(factors):
+    total = 1
+    for p, exponent in factors.items():
+        total *= (p ** (exponent + 1) - 1) // (p - 1)
+    return total
+
+
+def get_divisor_count(number):
+    return count_divisors(get_factors(number))
+
+
+def get_divisor_sum(number):
+    return sum_divisors(get_factors(number))
+
+
+def get_max_proper_divisor(number):
+    # None for 1, which has no proper divisors
+    factors = get_factors(number)
+    return number // next(iter(factors)) if factors else None
+
+
+def get_number_kind(number):
+    aliquot_sum = get_divisor_sum(number) - number
+    if aliquot_sum == number:
+        return "perfect"
+    return "abundant" if aliquot_sum > number else "deficient"
+
+
+AGGREGATES = {
+    "count": get_divisor_count,
+    "sum": get_divisor_sum,
+    "max_proper": get_max_proper_divisor,
+    "kind": get_number_kind,
+}
+
+
+def get_aggregates_of_numbers(*numbers, aggregate="count", processes=1):
+    timer = time()
+    function = AGGREGATES[aggregate]
+    if processes > 1:
+        with Pool(processes) as pool:
+            result = tuple(pool.map(function, numbers, chunksize=max(1, len(numbers) // (processes * CHUNKS_PER_WORKER))))
+    else:
+        result = tuple(function(number) for number in numbers)
+    logger.debug(f"Done {aggregate} aggregates with {processes} processes in {time() - timer} seconds\n")
+    return result
+
+
+def iter_range_factors(low, high, segment_size=SEGMENT_SIZE):
+    # Segmented sieve over [low, high): each segment is divided by the primes up to sqrt(high),
+    # whatever is left after that is a single prime factor
+    low = max(low, 1)
+    primes = get_small_primes(isqrt(max(high - 1, 1)))
+    for start in range(low, high, segment_size):
+        end = min(start + segment_size, high)
+        remaining = list(range(start, end))
+        factors = [{} for _ in remaining]
+        for p in primes:
+            if p * p >= end:
+                break
+            for i in range(-start % p, end - start, p):
+                number, exponent = remaining[i], 0
+                while number % p == 0:
+                    number //= p
+                    exponent += 1
+                remaining[i] = number
+                factors[i][p] = exponent
+        for i, number in enumerate(remaining):
+            if number > 1:
+                factors[i][number] = 1
+        yield from zip(range(start, end), factors)
+
+
+def filter_range(predicate, low, high, segment_size=SEGMENT_SIZE):
+    # predicate gets the number and its factorization, e.g. lambda n, f: sum_divisors(f) == 2 * n
+    return [number for number, factors in iter_range_factors(low, high, segment_size) if predicate(number, factors)]
+
+
+def process_range_segment(start, end, factors_only=False):
+    started = time()
+    factors = [factors for _, factors in iter_range_factors(start, end, end - start)]
+    if factors_only:
+        result = factors
+    else:
+        # Segments travel back to the parent as flat buffers
+        result = DivisorsArray.from_lists(get_divisors_from_factors(f) if f else [1, 1] for f in factors)
+    return start, os.getpid(), started, time(), result
+
+
+def iter_range_divisors(low, high, processes=CPU_COUNT, segment_size=SEGMENT_SIZE, factors_only=False, ordered=True, window=STREAM_WINDOW, instrumentation=None):
+    # Yields (number, divisors) or (number, factorization) for every number in [low, high), low is raised to 1.
+    # The range is split into segments that are sieved in parallel and streamed out as they finish.
+    low = max(low, 1)
+    segments = ((start, min(start + segment_size, high)) for start in range(low, high, segment_size))
+    if processes <= 1:
+        for start, end in segments:
+            *_, result = process_range_segment(start, end, factors_only)
+            yield from zip(range(start, end), result)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        tasks = ((start, process_range_segment, (start, end, factors_only), range(start, end)) for start, end in segments)
+        yield from iter_windowed(executor, tasks, ordered, window, instrumentation)
+
+
+def log_worker_stats(stats):
+    for pid, worker in sorted(stats["workers"].items()):
+        logger.debug(f"Worker {pid}: {worker['chunks']} chunks, busy {worker['busy']:.3f} of {stats['wall']:.3f} seconds ({worker['utilisation']:.0%})")
+    logger.debug("")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
     N = 10**3
     MIN, MAX = 10**6, 10**7
@@ -58,10 +644,17 @@ if __name__ == "__main__":
     for i in range(N):
         numbers.append(randint(MIN, MAX))
 
-    logging.debug(f"\nFinding all divisors for {N} random integers in range from {MIN} to {MAX-1}:\n")
+    logger.debug(f"\nFinding all divisors for {N} random integers in range from {MIN} to {MAX-1}:\n")
 
     result1 = get_divisors_of_numbers_single_process(*numbers)
-    result2 = get_divisors_of_numbers_multi_process_v1(*numbers)
-    result3 = get_divisors_of_numbers_multi_process_v2(*numbers)
+    stats2, stats3 = {}, {}
+    result2 = get_divisors_of_numbers_multi_process_v1(*numbers, stats=stats2)
+    log_worker_stats(stats2)
+    instrumentation = Instrumentation(measure_bytes=True)
+    result3 = get_divisors_of_numbers_multi_process_v2(*numbers, stats=stats3, instrumentation=instrumentation)
+    log_worker_stats(stats3)
+    summary = instrumentation.summary()
+    logger.debug(f"Tasks: {summary['tasks']}, compute {summary['compute_total']:.3f} seconds, queue wait {summary['queue_wait_total']:.3f} seconds, "
+                 f"sent {summary['bytes_sent']} bytes, received {summary['bytes_received']} bytes\n")
 
-    logging.debug(f"Equivalence of all results: {result1 == result2 == result3}")
+    logger.debug(f"Equivalence of all results: {result1 == result2 == result3}")
@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+
+from divisors import CPU_COUNT, STREAM_CHUNK_SIZE, iter_number_chunks, process_chunk
+from divisors_service import DivisorsService
+
+
+MAX_PENDING_CHUNKS = 4 * CPU_COUNT
+
+
+class AsyncDivisors:
+    # Asyncio front-end over one shared DivisorsService pool, at most max_pending chunks are queued at once.
+    # Without a service one is started on first use in a thread, spawning and warming up the pool
+    # blocks and must not run on the event loop.
+    def __init__(self, service=None, max_pending=MAX_PENDING_CHUNKS, chunk_size=STREAM_CHUNK_SIZE):
+        self.own_service = service is None
+        self.service = service
+        self.starting = None
+        self.max_pending = max_pending
+        self.chunk_size = chunk_size
+        self.loop = None
+        self.slots = None
+
+    async def get_service(self):
+        if self.service is None:
+            if self.starting is None:
+                self.starting = asyncio.ensure_future(asyncio.to_thread(DivisorsService))
+            try:
+                self.service = await asyncio.shield(self.starting)
+            except Exception:
+                self.starting = None
+                raise
+        return self.service
+
+    def get_slots(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.slots = asyncio.Semaphore(self.max_pending)
+        return self.slots
+
+    async def run_chunk(self, chunk):
+        # Waiting for a slot is the backpressure: callers are suspended instead of growing the pool queue.
+        # The slot is given back when the pool is done with the chunk, not when the caller stops waiting,
+        # so timed out or cancelled chunks still count until they leave the pool.
+        service = await self.get_service()
+        slots = self.get_slots()
+        await slots.acquire()
+        try:
+            future = service.executor.submit(process_chunk, 0, chunk)
+        except BaseException:
+            slots.release()
+            raise
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: release_slot(loop, slots))
+        *_, result = await asyncio.wrap_future(future)
+        return result
+
+    async def get_divisors(self, numbers, timeout=None):
+        chunks = list(iter_number_chunks(numbers, self.chunk_size))
+        results = await asyncio.wait_for(asyncio.gather(*(self.run_chunk(chunk) for chunk in chunks)), timeout)
+        return tuple(divisors for result in results for divisors in result)
+
+    async def iter_divisors(self, numbers, timeout=None, window=None):
+        # Yields (number, divisors) in input order, timeout applies to every chunk separately
+        window = window or self.max_pending
+        pending = deque()
+        try:
+            for chunk in iter_number_chunks(numbers, self.chunk_size):
+                pending.append((chunk, asyncio.ensure_future(asyncio.wait_for(self.run_chunk(chunk), timeout))))
+                if len(pending) >= window:
+                    chunk, task = pending.popleft()
+                    for item in zip(chunk, await task):
+                        yield item
+            while pending:
+                chunk, task = pending.popleft()
+                for item in zip(chunk, await task):
+                    yield item
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    def close(self):
+        if self.own_service and self.service is not None:
+            self.service.close()
+
+
+def release_slot(loop, slots):
+    # Runs in the pool's callback thread
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        # The loop is already closed, nobody waits for the slot anymore
+        pass
+
+
+default_divisors = None
+
+
+def get_default_divisors():
+    global default_divisors
+    if default_divisors is None:
+        default_divisors = AsyncDivisors()
+    return default_divisors
+
+
+async def divisors_async(numbers, timeout=None):
+    return await get_default_divisors().get_divisors(numbers, timeout)
+
+
+async def iter_divisors_async(numbers, timeout=None, window=None):
+    async for item in get_default_divisors().iter_divisors(numbers, timeout, window):
+        yield item
+
+
+def close_default_divisors():
+    global default_divisors
+    if default_divisors is not None:
+        default_divisors.close()
+        default_divisors = None
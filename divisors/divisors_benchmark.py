@@ -0,0 +1,175 @@
+import argparse
+import csv
+import json
+import logging
+from random import Random
+from statistics import median
+from time import perf_counter
+
+from divisors import (
+    CPU_COUNT,
+    SIEVE_LIMIT,
+    get_divisors_of_numbers_single_process,
+    get_divisors_of_numbers_multi_process_v1,
+    get_divisors_of_numbers_multi_process_v2,
+    iter_divisors,
+)
+
+try:
+    from divisors_numpy import get_divisors_of_numbers_numpy
+except ImportError:
+    get_divisors_of_numbers_numpy = None
+
+
+# Engines get the numbers, the number of workers and a dict the multi-process engines fill with chunk stats
+ENGINES = {
+    "single": lambda numbers, workers, stats: get_divisors_of_numbers_single_process(*numbers, use_sieve=False),
+    "single_sieve": lambda numbers, workers, stats: get_divisors_of_numbers_single_process(*numbers, use_sieve=True),
+    "v1": lambda numbers, workers, stats: get_divisors_of_numbers_multi_process_v1(*numbers, use_sieve=False, processes=workers, stats=stats),
+    "v1_sieve": lambda numbers, workers, stats: get_divisors_of_numbers_multi_process_v1(*numbers, use_sieve=True, processes=workers, stats=stats),
+    "v2": lambda numbers, workers, stats: get_divisors_of_numbers_multi_process_v2(*numbers, use_sieve=False, processes=workers, stats=stats),
+    "v2_sieve": lambda numbers, workers, stats: get_divisors_of_numbers_multi_process_v2(*numbers, use_sieve=True, processes=workers, stats=stats),
+    "stream": lambda numbers, workers, stats: list(iter_divisors(numbers, processes=workers)),
+}
+if get_divisors_of_numbers_numpy is not None:
+    ENGINES["numpy"] = lambda numbers, workers, stats: get_divisors_of_numbers_numpy(*numbers)
+SINGLE_PROCESS_ENGINES = ("single", "single_sieve", "numpy")
+# These build a sieve up to the largest number, above SIEVE_LIMIT it doesn't fit in memory (numpy refuses)
+SIEVE_ENGINES = ("single_sieve", "v1_sieve", "v2_sieve", "numpy")
+BASELINE_ENGINE = "single"
+CSV_FIELDS = ("engine", "n", "min", "max", "workers", "median", "p95", "min_time", "max_time", "speedup", "efficiency",
+              "chunks", "utilisation_mean", "utilisation_min", "utilisation_max", "skipped")
+
+
+def generate_numbers(n, low, high, seed):
+    random = Random(seed)
+    return [random.randrange(low, high) for _ in range(n)]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def measure(engine, numbers, workers, repeat, warmup, stats=None):
+    # stats are left from the last timed run
+    for _ in range(warmup):
+        engine(numbers, workers, stats)
+    timings = []
+    for _ in range(repeat):
+        timer = perf_counter()
+        engine(numbers, workers, stats)
+        timings.append(perf_counter() - timer)
+    return timings
+
+
+def summarize_stats(stats):
+    # Per-worker utilisation (busy time / wall time of the chunks) of the multi-process engines
+    workers = stats.get("workers")
+    if not workers:
+        return {"chunks": None, "utilisation_mean": None, "utilisation_min": None, "utilisation_max": None, "worker_stats": None}
+    utilisation = [worker["utilisation"] for worker in workers.values()]
+    return {
+        "chunks": stats["chunks"],
+        "utilisation_mean": sum(utilisation) / len(utilisation),
+        "utilisation_min": min(utilisation),
+        "utilisation_max": max(utilisation),
+        "worker_stats": [{"pid": pid, **worker} for pid, worker in workers.items()],
+    }
+
+
+def run_benchmark(sizes, ranges, workers_list, engines, repeat=5, warmup=1, seed=0):
+    rows = []
+    for n in sizes:
+        for low, high in ranges:
+            numbers = generate_numbers(n, low, high, seed)
+            group = []
+            for name in engines:
+                for workers in (1,) if name in SINGLE_PROCESS_ENGINES else workers_list:
+                    row = {"engine": name, "n": n, "min": low, "max": high, "workers": workers}
+                    if name in SIEVE_ENGINES and high - 1 > SIEVE_LIMIT:
+                        row.update(dict.fromkeys(("median", "p95", "min_time", "max_time")), skipped=f"numbers above SIEVE_LIMIT ({SIEVE_LIMIT})")
+                        row.update(summarize_stats({}))
+                        group.append(row)
+                        logging.info(f"{name:>12} n={n} range=[{low}, {high}) workers={workers}: skipped, {row['skipped']}")
+                        continue
+                    stats = {}
+                    timings = measure(ENGINES[name], numbers, workers, repeat, warmup, stats)
+                    row.update({
+                        "median": median(timings),
+                        "p95": percentile(timings, 0.95),
+                        "min_time": min(timings),
+                        "max_time": max(timings),
+                        "skipped": None,
+                    })
+                    row.update(summarize_stats(stats))
+                    group.append(row)
+                    logging.info(f"{name:>12} n={n} range=[{low}, {high}) workers={workers}: median {row['median']:.4f} s")
+
+            # Speedup and efficiency are relative to the single-process engine on the same inputs
+            baseline = next((row["median"] for row in group if row["engine"] == BASELINE_ENGINE), None)
+            for row in group:
+                row["speedup"] = baseline / row["median"] if baseline and row["median"] else None
+                row["efficiency"] = row["speedup"] / row["workers"] if row["speedup"] else None
+            rows.extend(group)
+    return rows
+
+
+def write_json(rows, path, settings):
+    with open(path, "w") as file:
+        json.dump({"settings": settings, "results": rows}, file, indent=2)
+
+
+def write_csv(rows, path):
+    with open(path, "w", newline="") as file:
+        # The per-worker breakdown only goes to the JSON output
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_rows(rows):
+    print(f"{'engine':>12} {'n':>8} {'range':>20} {'workers':>7} {'median':>9} {'p95':>9} {'speedup':>8} {'eff':>6} {'util':>11}")
+    for row in rows:
+        value_range = f"[{row['min']}, {row['max']})"
+        if row["skipped"]:
+            print(f"{row['engine']:>12} {row['n']:>8} {value_range:>20} {row['workers']:>7} skipped: {row['skipped']}")
+            continue
+        speedup = f"{row['speedup']:.2f}" if row["speedup"] else "-"
+        efficiency = f"{row['efficiency']:.2f}" if row["efficiency"] else "-"
+        utilisation = f"{row['utilisation_min']:.2f}-{row['utilisation_max']:.2f}" if row["utilisation_mean"] is not None else "-"
+        print(f"{row['engine']:>12} {row['n']:>8} {value_range:>20} {row['workers']:>7} {row['median']:>9.4f} {row['p95']:>9.4f} {speedup:>8} {efficiency:>6} "
+              f"{utilisation:>11}")
+
+
+def parse_range(value):
+    low, high = value.split(":")
+    return int(low), int(high)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the divisors engines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**3, 10**4])
+    parser.add_argument("--ranges", type=parse_range, nargs="+", default=[(10**6, 10**7)], help="low:high, high exclusive")
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, CPU_COUNT}))
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="path to write the results as JSON")
+    parser.add_argument("--csv", help="path to write the results as CSV")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    rows = run_benchmark(args.sizes, args.ranges, args.workers, args.engines, args.repeat, args.warmup, args.seed)
+    print_rows(rows)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("json", "csv")}
+    if args.json:
+        write_json(rows, args.json, settings)
+    if args.csv:
+        write_csv(rows, args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+from array import array
+from collections import OrderedDict
+import json
+import mmap
+import os
+import pickle
+import sqlite3
+from time import time
+
+
+class DivisorsArray:
+    # CSR layout: divisors of the i-th number are values[offsets[i]:offsets[i + 1]]
+    MAGIC = b"DIVCSR01"
+    TYPECODE = "q"
+
+    def __init__(self, values=None, offsets=None):
+        self.values = values if values is not None else array(self.TYPECODE)
+        self.offsets = offsets if offsets is not None else array(self.TYPECODE, [0])
+        self.mmap = None
+
+    @classmethod
+    def from_lists(cls, lists):
+        result = cls()
+        for divisors in lists:
+            result.append(divisors)
+        return result
+
+    @classmethod
+    def from_buffers(cls, values, offsets):
+        return cls(array(cls.TYPECODE, values), array(cls.TYPECODE, offsets))
+
+    def __reduce__(self):
+        # Pickles as two flat buffers instead of a Python int object per divisor
+        return self.__class__.from_buffers, (bytes(self.values), bytes(self.offsets))
+
+    def append(self, divisors):
+        try:
+            self.values.extend(divisors)
+        except OverflowError as error:
+            # The divisors converted before the failing one are already in, drop them
+            del self.values[self.offsets[-1]:]
+            raise ValueError(f"Divisors must fit in a signed 64-bit integer for the compact layout, got {max(divisors, key=abs)}, "
+                             "use compact=False for larger numbers") from error
+        self.offsets.append(len(self.values))
+
+    def append_from(self, other, index):
+        self.values.extend(other.values[other.offsets[index]:other.offsets[index + 1]])
+        self.offsets.append(len(self.values))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("DivisorsArray index out of range")
+        return self.values[self.offsets[index]:self.offsets[index + 1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (DivisorsArray, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def tolist(self):
+        return list(self)
+
+    def nbytes(self):
+        return len(self.values) * self.values.itemsize + len(self.offsets) * self.offsets.itemsize
+
+    def to_bytes(self):
+        header = self.MAGIC + len(self).to_bytes(8, "little")
+        return header + bytes(self.offsets) + bytes(self.values)
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.MAGIC + len(self).to_bytes(8, "little"))
+            file.write(self.offsets)
+            file.write(self.values)
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        with open(path, "rb") as file:
+            if not use_mmap:
+                data = memoryview(file.read())
+                return cls.from_memory(data, copy=True)
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        result = cls.from_memory(memoryview(data))
+        result.mmap = data
+        return result
+
+    @classmethod
+    def from_memory(cls, data, copy=False):
+        if bytes(data[:8]) != cls.MAGIC:
+            raise ValueError("Not a divisors array file")
+        count = int.from_bytes(data[8:16], "little")
+        offsets_end = 16 + 8 * (count + 1)
+        offsets = data[16:offsets_end].cast(cls.TYPECODE)
+        values = data[offsets_end:].cast(cls.TYPECODE)
+        if copy:
+            return cls.from_buffers(bytes(values), bytes(offsets))
+        return cls(values, offsets)
+
+    def close(self):
+        if self.mmap is not None:
+            self.values.release()
+            self.offsets.release()
+            self.mmap.close()
+            self.mmap = None
+
+
+class DivisorsCache:
+    # Bounded LRU of factorizations in memory, optionally backed by a sqlite file shared between processes.
+    # Writes to the file are buffered and go in one transaction per batch_size rows (and on flush/close),
+    # one autocommit per row made a cold run slower than no cache at all. Numbers below STORE_MIN factor
+    # faster than a sqlite lookup, they are only kept in memory.
+    STORE_MIN = 10**7
+
+    def __init__(self, maxsize=2**16, path=None, batch_size=1024):
+        self.maxsize = maxsize
+        self.path = path
+        self.batch_size = batch_size
+        self.factors = OrderedDict()
+        self.unsaved = {}
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.related_hits = 0
+        self.connection = None
+        self.pid = None
+
+    def get_connection(self):
+        # A connection must not cross a fork, every process opens its own one
+        if self.path is None:
+            return None
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS factors (number TEXT PRIMARY KEY, factors TEXT NOT NULL)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def peek(self, number):
+        factors = self.factors.get(number)
+        if factors is not None:
+            self.factors.move_to_end(number)
+            return dict(factors)
+        return None
+
+    def get(self, number):
+        factors = self.peek(number)
+        if factors is not None:
+            self.hits += 1
+            return factors
+        connection = self.get_connection() if number >= self.STORE_MIN else None
+        if connection is not None:
+            value = self.unsaved.get(str(number))
+            if value is None:
+                row = connection.execute("SELECT factors FROM factors WHERE number = ?", (str(number),)).fetchone()
+                value = row[0] if row is not None else None
+            if value is not None:
+                self.store_hits += 1
+                factors = decode_factors(value)
+                self.remember(number, factors)
+                return factors
+        self.misses += 1
+        return None
+
+    def remember(self, number, factors):
+        self.factors[number] = tuple(factors.items())
+        self.factors.move_to_end(number)
+        if len(self.factors) > self.maxsize:
+            self.factors.popitem(last=False)
+
+    def put(self, number, factors):
+        self.remember(number, factors)
+        if self.path is not None and number >= self.STORE_MIN:
+            self.unsaved[str(number)] = encode_factors(factors)
+            if len(self.unsaved) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        connection = self.get_connection()
+        if connection is None or not self.unsaved:
+            return
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany("INSERT OR IGNORE INTO factors VALUES (?, ?)", self.unsaved.items())
+        self.unsaved.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "store_hits": self.store_hits,
+            "related_hits": self.related_hits,
+            "size": len(self.factors),
+        }
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            self.flush()
+            self.connection.close()
+        self.connection = None
+        self.unsaved.clear()
+
+
+def encode_factors(factors):
+    return ",".join(f"{p}:{e}" for p, e in factors.items())
+
+
+def decode_factors(value):
+    # An empty factorization (the number 1) is stored as an empty string
+    return {int(p): int(e) for p, e in (item.split(":") for item in value.split(","))} if value else {}
+
+
+class Instrumentation:
+    # Collects per-task timings in the parent: workers only report pid and start/finish timestamps.
+    # measure_bytes pickles every task and result a second time in the parent to estimate the bytes
+    # sent and received, which roughly doubles serialization cost, so it is off unless asked for.
+    def __init__(self, measure_bytes=False):
+        self.measure_bytes = measure_bytes
+        self.pending = {}
+        self.tasks = []
+
+    def submitted(self, task_id, args=None):
+        size = len(pickle.dumps(args)) if self.measure_bytes and args is not None else 0
+        self.pending[task_id] = (time(), size)
+
+    def completed(self, task_id, pid, started, finished, result=None):
+        submitted, bytes_sent = self.pending.pop(task_id, (started, 0))
+        self.tasks.append({
+            "task": task_id,
+            "pid": pid,
+            "submitted": submitted,
+            "started": started,
+            "finished": finished,
+            "received": time(),
+            "bytes_sent": bytes_sent,
+            "bytes_received": len(pickle.dumps(result)) if self.measure_bytes and result is not None else 0,
+        })
+
+    def summary(self):
+        if not self.tasks:
+            return {"tasks": 0, "workers": {}}
+        workers = {}
+        for task in self.tasks:
+            worker = workers.setdefault(task["pid"], {"tasks": 0, "compute": 0.0, "queue_wait": 0.0, "bytes_sent": 0, "bytes_received": 0})
+            worker["tasks"] += 1
+            worker["compute"] += task["finished"] - task["started"]
+            worker["queue_wait"] += task["started"] - task["submitted"]
+            worker["bytes_sent"] += task["bytes_sent"]
+            worker["bytes_received"] += task["bytes_received"]
+        compute = [task["finished"] - task["started"] for task in self.tasks]
+        queue_wait = [task["started"] - task["submitted"] for task in self.tasks]
+        return {
+            "tasks": len(self.tasks),
+            "wall": max(task["received"] for task in self.tasks) - min(task["submitted"] for task in self.tasks),
+            "compute_total": sum(compute),
+            "compute_max": max(compute),
+            "queue_wait_total": sum(queue_wait),
+            "queue_wait_max": max(queue_wait),
+            "bytes_sent": sum(task["bytes_sent"] for task in self.tasks),
+            "bytes_received": sum(task["bytes_received"] for task in self.tasks),
+            "workers": workers,
+        }
+
+    def chrome_trace(self):
+        # Trace Event Format, open with chrome://tracing or Perfetto
+        if not self.tasks:
+            return {"traceEvents": []}
+        origin = min(task["submitted"] for task in self.tasks)
+        events = []
+        for task in self.tasks:
+            args = {"bytes_sent": task["bytes_sent"], "bytes_received": task["bytes_received"]}
+            events.append({"name": f"queue {task['task']}", "cat": "queue", "ph": "X", "pid": "queue", "tid": task["pid"],
+                           "ts": (task["submitted"] - origin) * 1e6, "dur": (task["started"] - task["submitted"]) * 1e6})
+            events.append({"name": f"task {task['task']}", "cat": "compute", "ph": "X", "pid": task["pid"], "tid": task["pid"],
+                           "ts": (task["started"] - origin) * 1e6, "dur": (task["finished"] - task["started"]) * 1e6, "args": args})
+        return {"traceEvents": events}
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace(), file)
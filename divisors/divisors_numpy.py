@@ -0,0 +1,80 @@
+from array import array
+import logging
+from time import time
+
+import numpy as np
+
+from divisors import SIEVE_LIMIT, get_spf_sieve
+from divisors_classes import DivisorsArray
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_divisors_csr(numbers):
+    # Factors the whole batch through the sieve one prime per round and multiplies the divisor
+    # sets round by round, so every step is an array operation over all numbers at once.
+    # Returns flat divisors and offsets, divisors of numbers[i] are values[offsets[i]:offsets[i + 1]].
+    numbers = np.asarray(numbers, dtype=np.int64)
+    size = len(numbers)
+    if size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    limit = int(numbers.max())
+    if limit > SIEVE_LIMIT:
+        raise ValueError(f"Numbers above {SIEVE_LIMIT} are not supported by the vectorized path")
+    sieve = np.frombuffer(get_spf_sieve(limit), dtype=np.uint32)
+
+    owners = np.arange(size)
+    values = np.ones(size, dtype=np.int64)
+    last_new = np.ones(size, dtype=bool)
+    remaining = np.where(numbers > 1, numbers, 1)
+    previous = np.zeros(size, dtype=np.int64)
+    done_owners, done_values = [], []
+    while True:
+        active = remaining > 1
+        # Divisors of fully factored numbers are final, later rounds only scan the rest
+        finished = ~active[owners]
+        if finished.any():
+            done_owners.append(owners[finished])
+            done_values.append(values[finished])
+            owners, values, last_new = owners[~finished], values[~finished], last_new[~finished]
+        if not len(owners):
+            break
+        primes = sieve[remaining].astype(np.int64)
+        primes = np.where(primes == 0, remaining, primes)
+        primes = np.where(active, primes, 0)
+        # Repeating the previous prime only extends the divisors added in the previous round
+        repeat = active & (primes == previous)
+        source = active[owners] & (last_new | ~repeat[owners])
+        new_owners = owners[source]
+        owners = np.concatenate((owners, new_owners))
+        values = np.concatenate((values, values[source] * primes[new_owners]))
+        last_new = np.concatenate((np.zeros(len(last_new), dtype=bool), np.ones(len(new_owners), dtype=bool)))
+        remaining = np.where(active, remaining // np.maximum(primes, 1), remaining)
+        previous = primes
+
+    # get_divisors returns [1, n] for n < 2, the extra divisor gets the largest sort key of its number
+    small = np.flatnonzero(numbers < 2)
+    span = max(limit, 1) + 2
+    owners = np.concatenate(done_owners + [small])
+    values = np.concatenate(done_values + [numbers[small]])
+    keys = owners * span + values
+    keys[len(owners) - len(small):] = small * span + span - 1
+
+    order = np.argsort(keys)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners, minlength=size), out=offsets[1:])
+    return values[order], offsets
+
+
+def get_divisors_of_numbers_numpy(*numbers, compact=False):
+    timer = time()
+    values, offsets = get_divisors_csr(numbers)
+    if compact:
+        result = DivisorsArray(array(DivisorsArray.TYPECODE, values.tobytes()), array(DivisorsArray.TYPECODE, offsets.tobytes()))
+    else:
+        flat = values.tolist()
+        bounds = offsets.tolist()
+        result = tuple(flat[bounds[i]:bounds[i + 1]] for i in range(len(numbers)))
+    logger.debug(f"Done with NumPy in {time() - timer} seconds\n")
+    return result
@@ -0,0 +1,130 @@
+import concurrent.futures
+import logging
+from time import perf_counter
+
+from divisors import (
+    CPU_COUNT,
+    collect_chunks,
+    get_cache_settings,
+    get_divisors,
+    get_divisors_with_sieve,
+    get_spf_sieve,
+    init_worker,
+    make_chunks,
+    process_chunk,
+    published_sieve,
+)
+from divisors_classes import DivisorsArray
+
+
+MIN_POOL_BATCH = 64
+MAX_POOL_BATCH = 10**5
+COST_SMOOTHING = 0.3
+CALIBRATION_SAMPLE = 16
+
+
+logger = logging.getLogger(__name__)
+
+
+class DivisorsService:
+    # Keeps a warm process pool (with the sieve attached, if a limit is given) for many batches
+    def __init__(self, processes=CPU_COUNT, limit=None, chunking="guided", min_pool_batch=MIN_POOL_BATCH):
+        self.processes = processes
+        self.chunking = chunking
+        self.threshold = min_pool_batch
+        self.min_pool_batch = min_pool_batch
+        self.local_cost = None
+        self.pool_overhead = None
+        self.sieve = get_spf_sieve(limit) if limit is not None else None
+        self.sieve_context = published_sieve(limit) if limit is not None else None
+        sieve_info = self.sieve_context.__enter__() if self.sieve_context else None
+        self.executor = None
+        try:
+            self.executor = concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker, initargs=(sieve_info, get_cache_settings()))
+            self.warm_up()
+        except BaseException as error:
+            # The shared sieve segment must not outlive a service that failed to start
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+            if self.sieve_context:
+                self.sieve_context.__exit__(type(error), error, error.__traceback__)
+            raise
+        self.closed = False
+
+    def warm_up(self):
+        # Starts every worker now instead of on the first batch
+        futures = [self.executor.submit(process_chunk, i, []) for i in range(self.processes)]
+        concurrent.futures.wait(futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.executor.shutdown(cancel_futures=True)
+        if self.sieve_context:
+            self.sieve_context.__exit__(None, None, None)
+
+    def get_divisors_locally(self, number):
+        if self.sieve is not None and number < len(self.sieve):
+            return get_divisors_with_sieve(number, self.sieve)
+        return get_divisors(number)
+
+    def get_divisors(self, numbers, compact=False, stats=None, instrumentation=None):
+        if self.closed:
+            raise RuntimeError("DivisorsService is closed")
+        numbers = tuple(numbers)
+        if not numbers:
+            return DivisorsArray() if compact else ()
+
+        timer = perf_counter()
+        if len(numbers) < self.threshold:
+            result = [self.get_divisors_locally(number) for number in numbers]
+            self.update_local_cost((perf_counter() - timer) / len(numbers))
+            result = DivisorsArray.from_lists(result) if compact else tuple(result)
+            logger.debug(f"Done {len(numbers)} numbers in process in {perf_counter() - timer} seconds")
+            return result
+
+        chunks = make_chunks(numbers, self.processes, self.chunking)
+        futures = []
+        for i, chunk in enumerate(chunks):
+            task = (i, [numbers[j] for j in chunk], compact)
+            if instrumentation is not None:
+                instrumentation.submitted(i, task)
+            futures.append(self.executor.submit(process_chunk, *task))
+        completed = (future.result() for future in concurrent.futures.as_completed(futures))
+        result = collect_chunks(completed, chunks, len(numbers), timer, stats, compact, instrumentation)
+        self.update_pool_overhead(perf_counter() - timer, numbers)
+        logger.debug(f"Done {len(numbers)} numbers with {self.processes} pooled processes in {perf_counter() - timer} seconds")
+        return result
+
+    def update_local_cost(self, cost):
+        self.local_cost = cost if self.local_cost is None else (1 - COST_SMOOTHING) * self.local_cost + COST_SMOOTHING * cost
+        self.update_threshold()
+
+    def update_pool_overhead(self, elapsed, numbers):
+        if self.local_cost is None:
+            # Nothing to compare against yet, measure the in-process cost on a sample of this batch
+            sample = numbers[::max(1, len(numbers) // CALIBRATION_SAMPLE)][:CALIBRATION_SAMPLE]
+            sample_timer = perf_counter()
+            for number in sample:
+                self.get_divisors_locally(number)
+            self.local_cost = (perf_counter() - sample_timer) / len(sample)
+        overhead = max(0.0, elapsed - len(numbers) * self.local_cost / self.processes)
+        self.pool_overhead = overhead if self.pool_overhead is None else (1 - COST_SMOOTHING) * self.pool_overhead + COST_SMOOTHING * overhead
+        self.update_threshold()
+
+    def update_threshold(self):
+        # The pool pays off once the parallel saving on the batch exceeds the fixed dispatch overhead
+        if self.local_cost is None or self.pool_overhead is None:
+            return
+        saving_per_number = self.local_cost * (1 - 1 / self.processes)
+        if saving_per_number <= 0:
+            self.threshold = MAX_POOL_BATCH
+            return
+        self.threshold = min(MAX_POOL_BATCH, max(self.min_pool_batch, int(self.pool_overhead / saving_per_number)))